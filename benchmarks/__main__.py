@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import time
+
+from benchmarks import environment  # first, it configures the bot before the bot is imported
+from telegram.ext import Application
+
+import calendarjobs
+import database
+import metrics
+import pdfbundles
+from accred import Accred
+from benchmarks import fakes, updates
+
+ADMIN_ID = 1000
+USER_ID = 2000
+WARMUP = 1  # iterations run before measuring, to fill the caches like in production
+
+
+def _errors() -> float:
+    return sum(value for (name, _), value in metrics.counters.items() if name == "handler_errors_total")
+
+
+async def _wait_calendar_job() -> None:
+    while calendarjobs.get_running_job() is not None:
+        await asyncio.sleep(0.001)
+    return
+
+
+async def _clear_calendar(calendar: fakes.FakeCalendar) -> None:
+    await database.clear_event_ids()
+    calendar.events_by_id.clear()
+    return
+
+
+async def _clear_bundles() -> None:
+    pdfbundles.bundles.clear()
+    return
+
+
+async def measure(application: Application, stub: fakes.StubBotRequest, make_update: any, iterations: int,
+                  before: any = None, after: any = None) -> dict[str, any]:
+    """Process the updates one after the other through the handlers of the bot, timing each of them."""
+    durations = []
+    errors = _errors()
+    calls = sum(stub.calls.values())
+    for iteration in range(WARMUP + iterations):
+        if iteration == WARMUP:
+            errors = _errors()
+            calls = sum(stub.calls.values())
+        if before is not None:
+            await before()
+        update = updates.parse(make_update(), application.bot)
+        start = time.perf_counter()
+        await application.process_update(update)
+        if after is not None:
+            await after()
+        if iteration >= WARMUP:
+            durations.append(time.perf_counter() - start)
+    durations.sort()
+    return {
+        'iterations': iterations,
+        'mean': sum(durations) / len(durations),
+        'p50': durations[len(durations) // 2],
+        'p95': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        'max': durations[-1],
+        'errors': int(_errors() - errors),
+        'telegram_calls': (sum(stub.calls.values()) - calls) / iterations,
+    }
+
+
+async def run(iterations: int, reservations: int, latency: float, verbose: bool = False) -> dict[str, dict[str, any]]:
+    """Start the stand-ins and the bot, then time every scenario. The prints of the bot are hidden unless verbose."""
+    results = {}
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        # Without the rate limiter: the benchmarks measure the work of the bot, not the limits of Telegram
+        env = await environment.start(reservations, latency)
+        await environment.register(ADMIN_ID, Accred.ADMIN)
+        await environment.register(USER_ID)
+        await _run_scenarios(env, iterations, results)
+        await environment.stop(env)
+    return results
+
+
+async def _run_scenarios(env: environment.Environment, iterations: int, results: dict[str, dict[str, any]]) -> None:
+    application = env.application
+    stub = env.telegram
+    results['reservations'] = await measure(
+        application, stub, lambda: updates.command(ADMIN_ID, "/reservations"), iterations)
+    pages = iter(["page_def_1", "page_all_0", "page_all_1", "page_def_0"] * iterations)
+    results['page callback'] = await measure(
+        application, stub, lambda: updates.callback(ADMIN_ID, next(pages)), iterations)
+    results['pdf (merge)'] = await measure(
+        application, stub, lambda: updates.command(ADMIN_ID, "/pdf"), iterations, before=_clear_bundles)
+    await pdfbundles.refresh()
+    results['pdf (bundle)'] = await measure(
+        application, stub, lambda: updates.command(ADMIN_ID, "/pdf"), iterations)
+    results['calendar (full sync)'] = await measure(
+        application, stub, lambda: updates.command(ADMIN_ID, "/calendar"), iterations,
+        before=lambda: _clear_calendar(env.calendar), after=_wait_calendar_job)
+    results['calendar (no change)'] = await measure(
+        application, stub, lambda: updates.command(ADMIN_ID, "/calendar"), iterations, after=_wait_calendar_job)
+    results['relay to support'] = await measure(
+        application, stub, lambda: updates.message(USER_ID, USER_ID, "Bonjour, une question !"), iterations)
+    # The team answers the last message relayed to the support group
+    ticket_id = next(reversed(database.recent_messages))
+    results['relay to user'] = await measure(
+        application, stub,
+        lambda: updates.message(ADMIN_ID, environment.SUPPORT_GROUP_ID, "Bonjour !", ticket_id), iterations)
+    return
+
+
+def report(results: dict[str, dict[str, any]]) -> str:
+    """Format the results as a table, durations in milliseconds."""
+    lines = [f"{'scenario':<22}{'n':>5}{'mean':>9}{'p50':>9}{'p95':>9}{'max':>9}{'errors':>8}{'tg calls':>10}"]
+    for name, result in results.items():
+        lines.append(f"{name:<22}{result['iterations']:>5}{result['mean'] * 1000:>9.2f}{result['p50'] * 1000:>9.2f}"
+                     f"{result['p95'] * 1000:>9.2f}{result['max'] * 1000:>9.2f}{result['errors']:>8}"
+                     f"{result['telegram_calls']:>10.1f}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the main interactions of the bot against local stand-ins.")
+    parser.add_argument("--iterations", type=int, default=50, help="Measured iterations of each scenario")
+    parser.add_argument("--reservations", type=int, default=300, help="Reservations served by the fake Truffe")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Milliseconds added to every call to Truffe, Google and Telegram")
+    parser.add_argument("--json", help="Also write the results to this file, e.g. to compare two commits")
+    parser.add_argument("--verbose", action="store_true", help="Show what the bot prints")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.iterations, args.reservations, args.latency / 1000, args.verbose))
+    print(report(results))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
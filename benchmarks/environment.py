@@ -0,0 +1,77 @@
+import dataclasses
+import os
+import tempfile
+
+# The bot reads its configuration when imported: point it to the local stand-ins before importing it, and never to
+# the production services even if a .env file is present. Import this module before any module of the bot.
+os.environ.update({
+    'ENV': 'TEST',
+    'TOKEN': '123456:benchmark',
+    'TRUFFE_TOKEN': 'benchmark',
+    'CALENDAR_ID': 'benchmark',
+    'MONGO_URI': 'mongodb://127.0.0.1:1',
+    'SUPPORT_GROUP_ID': '-1001',
+    'MAINTAINERS_GROUP_ID': '-1002',
+    'AGREEMENT_CACHE_DIR': tempfile.mkdtemp(prefix='agreements-'),
+})
+os.environ.pop('UPDATE_TRACE_PATH', None)
+
+import httpx
+from mongomock_motor import AsyncMongoMockClient
+from telegram.ext import Application
+
+import database
+import main
+import managecalendar
+import pdfmerge
+import truffeclient
+from accred import Accred
+from benchmarks import fakes
+
+SUPPORT_GROUP_ID = int(os.environ['SUPPORT_GROUP_ID'])
+MAINTAINERS_GROUP_ID = int(os.environ['MAINTAINERS_GROUP_ID'])
+
+
+@dataclasses.dataclass
+class Environment:
+    """The bot wired to the local stand-ins."""
+    application: Application
+    truffe: fakes.FakeTruffe
+    calendar: fakes.FakeCalendar
+    telegram: fakes.StubBotRequest
+
+
+async def register(user_id: int, accred: Accred = Accred.NONE) -> None:
+    """Register a user of the benchmarks, with the given accreditation."""
+    await database.register_user(user_id, f"User{user_id}", "Bench", f"user{user_id}")
+    if accred != Accred.NONE:
+        await database.update_accred(user_id, accred)
+    return
+
+
+async def start(reservations: int, latency: float, rate_limited: bool = False) -> Environment:
+    """Start the stand-ins, then the bot with all the handlers of main, without polling Telegram.
+    latency is added to every call to Truffe, Google and Telegram, in seconds."""
+    pdfmerge.start()
+    truffe_server = fakes.FakeTruffe(fakes.make_reservations(reservations), latency)
+    truffeclient.http_client = httpx.AsyncClient(base_url=await truffe_server.start(), timeout=truffeclient.TIMEOUT,
+                                                 limits=truffeclient.LIMITS, follow_redirects=True)
+    database.setup(AsyncMongoMockClient())
+    calendar = fakes.FakeCalendar(latency)
+    managecalendar.calendar_service = calendar
+    stub = fakes.StubBotRequest(latency)
+
+    application = main.build_application(request=stub, rate_limited=rate_limited)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    return Environment(application=application, truffe=truffe_server, calendar=calendar, telegram=stub)
+
+
+async def stop(environment: Environment) -> None:
+    """Stop the bot, then the stand-ins."""
+    await environment.application.stop()
+    await environment.application.post_shutdown(environment.application)
+    await environment.application.shutdown()
+    await environment.truffe.stop()
+    return
@@ -0,0 +1,249 @@
+import asyncio
+import datetime
+import io
+import itertools
+import json
+import time
+import uuid
+
+import httplib2
+import pypdf
+import pytz
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+from googleapiclient.errors import HttpError
+from telegram.request import BaseRequest, RequestData
+
+# Local stand-ins for the services the bot talks to, so that it can be measured without any credentials
+
+TIMEZONE = pytz.timezone("Europe/Zurich")
+AGREEMENT_PAGES = 2
+
+
+def make_reservations(count: int, current_half_day: int = 8) -> list[dict]:
+    """Records in the format of the Truffe json: current_half_day validated reservations start in the current
+    half day, so that /pdf has something to merge, the others are spread over the next two weeks."""
+    now = datetime.datetime.now(TIMEZONE)
+    states = itertools.cycle(['2_online', '2_online', '1_asking', '0_draft'])
+    reservations = []
+    for pk in range(1, count + 1):
+        if pk <= current_half_day:
+            start = now.replace(minute=0, second=0, microsecond=0)
+            state = '2_online'
+        else:
+            start = now + datetime.timedelta(hours=12 + (pk * 5) % (14 * 24))
+            start = start.replace(minute=0, second=0, microsecond=0)
+            state = next(states)
+        reservations.append({
+            'pk': pk,
+            'state': state,
+            'title': f"Réservation {pk}",
+            'asking_unit_name': f"Unité {pk % 17}",
+            'contact_phone': "+41 21 000 00 00",
+            'contact_telegram': f"@user{pk}",
+            'start_date': start.isoformat(),
+            'end_date': (start + datetime.timedelta(days=1)).isoformat(),
+            'reason': "Événement",
+            'remarks': None,
+        })
+    return reservations
+
+
+def make_pdf(pages: int = AGREEMENT_PAGES) -> bytes:
+    """A blank pdf of the given number of pages."""
+    writer = pypdf.PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=595, height=842)
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+class _ReservationsHandler(tornado.web.RequestHandler):
+    def initialize(self, truffe: 'FakeTruffe') -> None:
+        self.truffe = truffe
+
+    async def get(self) -> None:
+        await asyncio.sleep(self.truffe.latency)
+        self.truffe.requests += 1
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({'supplyreservations': self.truffe.reservations}))
+
+
+class _AgreementHandler(tornado.web.RequestHandler):
+    def initialize(self, truffe: 'FakeTruffe') -> None:
+        self.truffe = truffe
+
+    async def get(self, pk: str) -> None:
+        await asyncio.sleep(self.truffe.latency)
+        self.truffe.requests += 1
+        self.set_header("Content-Type", "application/pdf")
+        self.write(self.truffe.agreement)
+
+
+class FakeTruffe:
+    """A local HTTP server answering like Truffe for the reservations list and the agreements."""
+
+    def __init__(self, reservations: list[dict], latency: float = 0.0) -> None:
+        self.reservations = reservations
+        self.latency = latency
+        self.agreement = make_pdf()
+        self.requests = 0
+        self.server: tornado.httpserver.HTTPServer = None
+        self.url: str = None
+
+    async def start(self) -> str:
+        """Start listening on a free local port, return the url to use in place of TRUFFE_PATH."""
+        app = tornado.web.Application([
+            (r"/logistics/api/supplyreservations", _ReservationsHandler, {'truffe': self}),
+            (r"/logistics/loanagreement/(\d+)/pdf/", _AgreementHandler, {'truffe': self}),
+        ])
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        self.server = tornado.httpserver.HTTPServer(app)
+        self.server.add_sockets(sockets)
+        self.url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}/logistics/"
+        return self.url
+
+    async def stop(self) -> None:
+        self.server.stop()
+        await self.server.close_all_connections()
+        return
+
+
+class _CalendarRequest:
+    def __init__(self, calendar: 'FakeCalendar', method: str, **kwargs: any) -> None:
+        self.calendar = calendar
+        self.method = method
+        self.kwargs = kwargs
+
+    def execute(self) -> any:
+        time.sleep(self.calendar.latency)
+        self.calendar.round_trips += 1
+        return self.calendar.apply(self)
+
+
+class _CalendarEvents:
+    def __init__(self, calendar: 'FakeCalendar') -> None:
+        self.calendar = calendar
+
+    def insert(self, **kwargs: any) -> _CalendarRequest:
+        return _CalendarRequest(self.calendar, 'insert', **kwargs)
+
+    def patch(self, **kwargs: any) -> _CalendarRequest:
+        return _CalendarRequest(self.calendar, 'patch', **kwargs)
+
+    def delete(self, **kwargs: any) -> _CalendarRequest:
+        return _CalendarRequest(self.calendar, 'delete', **kwargs)
+
+    def list(self, **kwargs: any) -> _CalendarRequest:
+        return _CalendarRequest(self.calendar, 'list', **kwargs)
+
+
+class _CalendarBatch:
+    def __init__(self, calendar: 'FakeCalendar', callback: any) -> None:
+        self.calendar = calendar
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request: _CalendarRequest, request_id: str) -> None:
+        self.requests.append((request_id, request))
+
+    def execute(self) -> None:
+        # Runs in a worker thread like the real client, one round trip for the whole batch
+        time.sleep(self.calendar.latency)
+        self.calendar.round_trips += 1
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, self.calendar.apply(request), None)
+            except Exception as e:
+                self.callback(request_id, None, e)
+
+
+def _http_error(status: int) -> HttpError:
+    return HttpError(httplib2.Response({'status': status}), b'{"error": {"message": "fake calendar"}}')
+
+
+class FakeCalendar:
+    """Stands for the Google Calendar service built by managecalendar, keeping the events in memory."""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.events_by_id: dict[str, dict] = {}
+        # event id -> HTTP status answered to any operation on the event
+        self.errors: dict[str, int] = {}
+        self.round_trips = 0
+
+    def events(self) -> _CalendarEvents:
+        return _CalendarEvents(self)
+
+    def new_batch_http_request(self, callback: any) -> _CalendarBatch:
+        return _CalendarBatch(self, callback)
+
+    def apply(self, request: _CalendarRequest) -> any:
+        if request.method == 'list':
+            # One page holds every event, like the real calendar below maxResults events
+            return {'items': [{'id': event_id} for event_id in self.events_by_id]}
+        if request.method == 'insert':
+            event = dict(request.kwargs['body'], id=uuid.uuid4().hex)
+            self.events_by_id[event['id']] = event
+            return event
+        event_id = request.kwargs['eventId']
+        if event_id in self.errors:
+            raise _http_error(self.errors[event_id])
+        if event_id not in self.events_by_id:
+            # What Google answers for an event deleted by hand
+            raise _http_error(404)
+        if request.method == 'patch':
+            self.events_by_id[event_id].update(request.kwargs['body'])
+            return self.events_by_id[event_id]
+        del self.events_by_id[event_id]
+        return ""
+
+
+class StubBotRequest(BaseRequest):
+    """Answers the Bot API calls locally with plausible results, counting them by method."""
+
+    def __init__(self, latency: float = 0.0, bot_id: int = 1) -> None:
+        self.latency = latency
+        self.bot_id = bot_id
+        self.message_ids = itertools.count(1)
+        self.calls: dict[str, int] = {}
+
+    async def initialize(self) -> None:
+        return
+
+    async def shutdown(self) -> None:
+        return
+
+    def _message(self, parameters: dict) -> dict:
+        chat_id = parameters.get('chat_id', 0)
+        chat_id = int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0
+        return {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'},
+            'from': {'id': self.bot_id, 'is_bot': True, 'first_name': "Bot", 'username': "bench_bot"},
+            'text': parameters.get('text', ""),
+        }
+
+    async def do_request(self, url: str, method: str, request_data: RequestData = None, read_timeout: any = None,
+                         write_timeout: any = None, connect_timeout: any = None,
+                         pool_timeout: any = None) -> tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        await asyncio.sleep(self.latency)
+        parameters = request_data.parameters if request_data is not None else {}
+        if endpoint == 'getMe':
+            result = {'id': self.bot_id, 'is_bot': True, 'first_name': "Bot", 'username': "bench_bot",
+                      'can_join_groups': True, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': False}
+        elif endpoint.startswith('send') or endpoint in ('forwardMessage', 'editMessageText'):
+            result = self._message(parameters)
+        elif endpoint == 'copyMessage':
+            result = {'message_id': next(self.message_ids)}
+        elif endpoint == 'getUpdates':
+            result = []
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import time
+
+from benchmarks import environment  # first, it configures the bot before the bot is imported
+from telegram import Update
+from telegram.ext import CallbackContext, TypeHandler
+
+import database
+import metrics
+import tracing
+from accred import Accred
+from benchmarks import updates
+
+# Share of each kind of update in the synthetic load, close to what the bot receives during the season
+MIX = {
+    'reservations': 15,
+    'page': 25,
+    'reservation': 15,
+    'pdf': 3,
+    'help': 2,
+    'support': 25,
+    'reply': 15,
+}
+TEAM_SIZE = 20
+USER_COUNT = 200
+DRAIN_TIMEOUT = 60  # seconds waited for the last updates once they are all sent
+
+sent_at: dict[int, float] = {}
+latencies: list[float] = []
+
+
+async def _record_done(update: Update, context: CallbackContext) -> None:
+    """Last handler of every update, the latency covers the queue and all the other handlers."""
+    start = sent_at.pop(update.update_id, None)
+    if start is not None:
+        latencies.append(time.perf_counter() - start)
+    return
+
+
+def _errors() -> float:
+    return sum(value for (name, _), value in metrics.counters.items() if name == "handler_errors_total")
+
+
+def synthetic_updates(count: int, reservations: int, seed: int = 0) -> list[dict]:
+    """Raw updates drawn from MIX, sent by the team for the logistics features and by users for the support."""
+    rng = random.Random(seed)
+    kinds = rng.choices(list(MIX), weights=list(MIX.values()), k=count)
+    team = [1000 + index for index in range(TEAM_SIZE)]
+    users = [2000 + index for index in range(USER_COUNT)]
+    raw = []
+    for kind in kinds:
+        member = rng.choice(team)
+        if kind == 'reservations':
+            raw.append(updates.command(member, "/reservations"))
+        elif kind == 'page':
+            raw.append(updates.callback(member, f"page_{rng.choice(['def', 'all'])}_{rng.randrange(3)}"))
+        elif kind == 'reservation':
+            raw.append(updates.callback(member, f"{rng.randrange(1, reservations + 1)}_def_0"))
+        elif kind == 'pdf':
+            raw.append(updates.command(member, "/pdf"))
+        elif kind == 'help':
+            raw.append(updates.command(rng.choice(users), "/help"))
+        elif kind == 'support':
+            user = rng.choice(users)
+            raw.append(updates.message(user, user, "x" * rng.randrange(10, 400)))
+        else:
+            # Answered to the last ticket when the update is sent, see _resolve
+            raw.append(updates.message(member, environment.SUPPORT_GROUP_ID, "x" * rng.randrange(10, 200), 0))
+    return raw
+
+
+def _resolve(raw: dict) -> dict:
+    """Fill what depends on the previous updates: the ticket a synthetic reply answers."""
+    message = raw.get('message')
+    if message is None:
+        return raw
+    reply = message.get('reply_to_message')
+    if reply is not None and reply['message_id'] == 0:
+        tickets = [copy_id for copy_id, relayed in database.recent_messages.items()
+                   if relayed['chat_id'] != environment.SUPPORT_GROUP_ID]
+        reply['message_id'] = tickets[-1] if tickets else 1
+    return raw
+
+
+def read_trace(path: str) -> tuple[list[float], list[dict]]:
+    """Read a trace recorded by the bot, mapping its groups to the groups of the benchmarks."""
+    groups = {tracing.SUPPORT_CHAT: environment.SUPPORT_GROUP_ID,
+              tracing.MAINTAINERS_CHAT: environment.MAINTAINERS_GROUP_ID}
+    times = []
+    raw = []
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            times.append(entry['t'])
+            raw.append(_map_groups(entry['update'], groups))
+    return times, raw
+
+
+def _map_groups(data: any, groups: dict[int, int]) -> any:
+    if isinstance(data, list):
+        return [_map_groups(value, groups) for value in data]
+    if isinstance(data, dict):
+        return {key: groups.get(value, value) if key in ('id', 'chat_id') and isinstance(value, int)
+                else _map_groups(value, groups) for key, value in data.items()}
+    return data
+
+
+def _people(raw: list[dict]) -> set[int]:
+    """The users that sent the updates, registered before the replay."""
+    people = set()
+    for data in raw:
+        for kind in ('message', 'edited_message', 'callback_query'):
+            if kind in data and 'from' in data[kind]:
+                people.add(data[kind]['from']['id'])
+    return people
+
+
+async def run(times: list[float], raw: list[dict], register: dict[int, Accred], reservations: int, latency: float,
+              rate_limited: bool) -> dict[str, any]:
+    """Send the updates to the bot at the given times, in seconds from the start, and measure how long each takes."""
+    env = await environment.start(reservations, latency, rate_limited)
+    for user_id, accred in register.items():
+        await environment.register(user_id, accred)
+    env.application.add_handler(TypeHandler(Update, _record_done), group=1000)
+    errors = _errors()
+
+    start = time.perf_counter()
+    for at, data in zip(times, raw):
+        delay = start + at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = updates.parse(_resolve(data), env.application.bot)
+        sent_at[update.update_id] = time.perf_counter()
+        await env.application.update_queue.put(update)
+    sending = time.perf_counter() - start
+    deadline = time.perf_counter() + DRAIN_TIMEOUT
+    while sent_at and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'updates': len(raw),
+        'processed': len(latencies),
+        'lost': len(sent_at),
+        'offered_rate': len(raw) / sending if sending > 0 else None,
+        'throughput': len(latencies) / elapsed,
+        'errors': int(_errors() - errors),
+        'telegram_calls': sum(env.telegram.calls.values()),
+    }
+    ordered = sorted(latencies)
+    for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        result[name] = ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else None
+    result['max'] = ordered[-1] if ordered else None
+    await environment.stop(env)
+    return result
+
+
+def report(result: dict[str, any]) -> str:
+    def ms(seconds: float | None) -> str:
+        return "-" if seconds is None else f"{seconds * 1000:.1f} ms"
+
+    offered = "-" if result['offered_rate'] is None else f"{result['offered_rate']:.1f}/s"
+    return '\n'.join([
+        f"Updates : {result['updates']} sent at {offered}, {result['processed']} processed, {result['lost']} lost",
+        f"Throughput : {result['throughput']:.1f} updates/s",
+        f"Latency : p50 {ms(result['p50'])}, p95 {ms(result['p95'])}, p99 {ms(result['p99'])}, max {ms(result['max'])}",
+        f"Errors : {result['errors']}",
+        f"Telegram calls : {result['telegram_calls']}",
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Push a stream of updates through the handlers of the bot.")
+    parser.add_argument("--rate", type=float, default=20, help="Synthetic updates per second")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of synthetic load")
+    parser.add_argument("--replay", help="Replay a trace recorded with UPDATE_TRACE_PATH instead of synthetic load")
+    parser.add_argument("--speed", type=float, default=1, help="Replay the trace this many times faster")
+    parser.add_argument("--reservations", type=int, default=300, help="Reservations served by the fake Truffe")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Milliseconds added to every call to Truffe, Google and Telegram")
+    parser.add_argument("--rate-limited", action="store_true", help="Send through the rate limiter of production")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic load")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show what the bot prints")
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        times, raw = read_trace(args.replay)
+        times = [at / args.speed for at in times]
+        # Everybody in the trace can use everything, the trace decides which handlers run
+        users = {user_id: Accred.ADMIN for user_id in _people(raw)}
+    else:
+        count = int(args.rate * args.duration)
+        times = [index / args.rate for index in range(count)]
+        raw = synthetic_updates(count, args.reservations, args.seed)
+        users = {1000 + index: Accred.TEAM_MEMBER for index in range(TEAM_SIZE)}
+        users |= {2000 + index: Accred.EXTERNAL for index in range(USER_COUNT)}
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        result = asyncio.run(run(times, raw, users, args.reservations, args.latency / 1000, args.rate_limited))
+    print(report(result))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=4)
@@ -0,0 +1,66 @@
+import itertools
+import time
+
+from telegram import Bot, Update
+
+# Raw updates in the format Telegram sends them, for the benchmarks and the load tests
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1_000_000)
+
+
+def _user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'last_name': "Bench",
+            'username': f"user{user_id}"}
+
+
+def _chat(chat_id: int) -> dict:
+    if chat_id < 0:
+        return {'id': chat_id, 'type': 'supergroup', 'title': "Support"}
+    return {'id': chat_id, 'type': 'private', 'first_name': f"User{chat_id}"}
+
+
+def command(user_id: int, text: str) -> dict:
+    """A command sent in the private chat with the bot, e.g. "/pdf all"."""
+    name = text.split()[0]
+    return {
+        'update_id': next(update_ids),
+        'message': {
+            'message_id': next(message_ids), 'date': int(time.time()), 'chat': _chat(user_id),
+            'from': _user(user_id), 'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(name)}],
+        },
+    }
+
+
+def callback(user_id: int, data: str, message_id: int = 1) -> dict:
+    """A tap on an inline button of a message the bot sent in the private chat."""
+    return {
+        'update_id': next(update_ids),
+        'callback_query': {
+            'id': str(next(update_ids)), 'from': _user(user_id), 'chat_instance': str(user_id), 'data': data,
+            'message': {'message_id': message_id, 'date': int(time.time()), 'chat': _chat(user_id),
+                        'text': "Choisissez une reservation :"},
+        },
+    }
+
+
+def message(user_id: int, chat_id: int, text: str, reply_to_message_id: int = None) -> dict:
+    """A text message, in a private chat or in the support group, replying to a message or not."""
+    update = {
+        'update_id': next(update_ids),
+        'message': {
+            'message_id': next(message_ids), 'date': int(time.time()), 'chat': _chat(chat_id),
+            'from': _user(user_id), 'text': text,
+        },
+    }
+    if reply_to_message_id is not None:
+        update['message']['reply_to_message'] = {
+            'message_id': reply_to_message_id, 'date': int(time.time()), 'chat': _chat(chat_id),
+            'from': {'id': 1, 'is_bot': True, 'first_name': "Bot"}, 'text': "...",
+        }
+    return update
+
+
+def parse(data: dict, bot: Bot) -> Update:
+    return Update.de_json(data, bot)
@@ -0,0 +1,39 @@
+import asyncio
+import dataclasses
+
+import telegram
+
+import outbox
+
+MAX_CONCURRENT_SENDS = 10
+
+
+@dataclasses.dataclass
+class BroadcastResult:
+    """Outcome of a broadcast: the chats reached and the error of each chat that was not."""
+    sent: list[int] = dataclasses.field(default_factory=list)
+    failed: dict[int, Exception] = dataclasses.field(default_factory=dict)
+
+
+async def broadcast(bot: telegram.Bot, chat_ids: list[int], text: str, max_concurrent: int = MAX_CONCURRENT_SENDS,
+                    **kwargs: any) -> BroadcastResult:
+    """Send the same message to several chats concurrently, as notifications for the rate limiter of the bot.
+    kwargs are passed to every send_message, e.g. the reply_markup shared by all the messages."""
+    semaphore = asyncio.Semaphore(max_concurrent)
+    result = BroadcastResult()
+
+    async def send(chat_id: int) -> None:
+        async with semaphore:
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=outbox.NOTIFICATION, **kwargs)
+                result.sent.append(chat_id)
+            except telegram.error.TelegramError as e:
+                result.failed[chat_id] = e
+        return
+
+    # dict.fromkeys drops the duplicated chats but keeps the order
+    await asyncio.gather(*[send(chat_id) for chat_id in dict.fromkeys(chat_ids)])
+    for chat_id, error in result.failed.items():
+        print(f"Failed to send the broadcast to {chat_id}.")
+        print(error)
+    return result
@@ -0,0 +1,139 @@
+import asyncio
+import uuid
+
+import telegram
+from telegram.ext import Application
+
+import managecalendar
+import truffe
+
+REFRESH = "refresh"
+CLEAR = "clear"
+
+PROGRESS_INTERVAL = 2  # seconds between two edits of the progress messages
+
+MESSAGES = {
+    REFRESH: {
+        "running": "Mise à jour du calendrier en cours 📅",
+        "done": "Le calendrier a été mis à jour! 📅",
+        "failed": "Erreur lors de la mise à jour du calendrier. 😢",
+    },
+    CLEAR: {
+        "running": "Vidage du calendrier en cours 📅",
+        "done": "Le calendrier a été vidé! 📅",
+        "failed": "Erreur lors du vidage du calendrier. 😢",
+    },
+}
+
+
+class CalendarJob:
+    """A calendar operation running in the background, reporting its progress in Telegram messages."""
+
+    def __init__(self, kind: str) -> None:
+        self.id = uuid.uuid4().hex[:8]
+        self.kind = kind
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.messages: list[telegram.Message] = []
+        # message id -> text the message currently shows, Telegram rejects an edit that changes nothing
+        self.shown: dict[int, str] = {}
+        self._finished = asyncio.Event()
+
+    def progress(self, done: int, total: int) -> None:
+        """Called after each batch of calendar operations."""
+        self.done = done
+        self.total = total
+        return
+
+    def add_message(self, message: telegram.Message, text: str) -> None:
+        """Report the progress in a message sent with the given text."""
+        self.messages.append(message)
+        self.shown[message.message_id] = text
+        return
+
+    def text(self) -> str:
+        """Return the text of the progress messages."""
+        if self.result is not None:
+            return MESSAGES[self.kind]["done" if self.result else "failed"]
+        text = f"{MESSAGES[self.kind]['running']} (job {self.id})"
+        if self.total is not None:
+            text += f"\n{self.done}/{self.total} événements traités"
+        return text
+
+    async def _run_sync(self) -> bool:
+        if self.kind == REFRESH:
+            reservations = await truffe.get_reservations()
+            return await managecalendar.refresh_calendar(reservations, self.progress)
+        return await managecalendar.clear_calendar(self.progress)
+
+    async def _report_progress(self) -> None:
+        """Edit the progress messages until the job is finished."""
+        while True:
+            text = self.text()
+            for message in self.messages:
+                if self.shown.get(message.message_id) != text:
+                    try:
+                        await message.edit_text(text)
+                        self.shown[message.message_id] = text
+                    except telegram.error.TelegramError as e:
+                        print(f"Failed to report the progress of calendar job {self.id}.")
+                        print(e)
+            if self._finished.is_set():
+                return
+            try:
+                await asyncio.wait_for(self._finished.wait(), PROGRESS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self) -> bool:
+        """Run the calendar operation, then report its result."""
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            self.result = await self._run_sync()
+        except Exception:
+            self.result = False
+            raise
+        finally:
+            running.pop(self.kind, None)
+            self._finished.set()
+            await reporter
+        return self.result
+
+
+# Jobs in progress, by kind
+running: dict[str, CalendarJob] = {}
+
+
+def get_running_job() -> CalendarJob | None:
+    """Return the calendar job in progress, if any."""
+    return next(iter(running.values()), None)
+
+
+async def submit(application: Application, kind: str, message: telegram.Message,
+                 update: object = None) -> CalendarJob | None:
+    """Start a calendar job and report its progress as a reply to the message.
+    Joins the job of the same kind already in progress, returns None if a job of another kind is running."""
+    job = get_running_job()
+    if job is not None and job.kind != kind:
+        return None
+    if job is None:
+        job = CalendarJob(kind)
+        running[kind] = job
+        try:
+            text = job.text()
+            job.add_message(await message.reply_text(text), text)
+        except Exception:
+            running.pop(kind)
+            raise
+        # Exceptions of the job are sent to the error handlers of the application like the ones of handlers
+        application.create_task(job.run(), update=update)
+        return job
+    text = job.text()
+    reply = await message.reply_text(text)
+    if job.result is None:
+        job.add_message(reply, text)
+    elif job.text() != text:
+        # The job finished while we were replying
+        await reply.edit_text(job.text())
+    return job
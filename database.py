@@ -1,9 +1,14 @@
+import asyncio
+import collections
 import datetime
+import time
 
+import motor.motor_asyncio
 import pymongo
-from dotenv import load_dotenv
+import pymongo.monitoring
 
 import env
+import metrics
 from accred import Accred
 
 # Constants
@@ -16,93 +21,292 @@ USERS_COLLECTION_NAME = "users"
 EVENTS_COLLECTION_NAME = "events"
 MESSAGES_COLLECTION_NAME_DEV = "msgdev"
 MESSAGES_COLLECTION_NAME_PROD = "messages"
-MESSAGES_COLLECTION_NAME = MESSAGES_COLLECTION_NAME_PROD if env.get_env_variables()['ENV'] == 'PROD' else MESSAGES_COLLECTION_NAME_DEV
+MESSAGES_COLLECTION_NAME = MESSAGES_COLLECTION_NAME_PROD if env.get_config().env == 'PROD' else MESSAGES_COLLECTION_NAME_DEV
 UNITS_COLLECTION_NAME = "units"
 LOGS_COLLECTION_NAME = "logs"
 
-mongo_client: pymongo.MongoClient = None
+MAX_POOL_SIZE = 20  # connections shared by all the handlers
+USER_CACHE_TTL = 300  # seconds, bounds how long a change made by another process can go unnoticed
+
+RECENT_MESSAGES_SIZE = 1000  # relayed messages kept in memory, the replies of the team usually target them
+
+LOG_QUEUE_SIZE = 5000  # logs kept in memory while waiting to be written
+LOG_FLUSH_SIZE = 100  # logs written as soon as that many are queued
+LOG_FLUSH_INTERVAL = 5  # seconds, maximum time a log waits to be written
+LOG_OVERFLOW_DROP = "drop"  # when the queue is full, drop the new logs
+LOG_OVERFLOW_SAMPLE = "sample"  # when the queue is full, replace the oldest log with one new log out of LOG_SAMPLE_RATE
+LOG_OVERFLOW_POLICY = LOG_OVERFLOW_SAMPLE
+LOG_SAMPLE_RATE = 10
+
+mongo_client: motor.motor_asyncio.AsyncIOMotorClient = None
+
+# telegram_id -> (time until which the entry is valid, user document or None if not registered)
+user_cache: dict[int, tuple[float, dict | None]] = {}
+user_cache_hits = 0
+user_cache_misses = 0
+
+# copy_id -> message document, the last relayed messages in insertion order
+recent_messages: collections.OrderedDict[int, dict] = collections.OrderedDict()
+
+log_queue: asyncio.Queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+log_flush_needed = asyncio.Event()
+log_flusher: asyncio.Task = None
+logs_written = 0
+logs_dropped = 0
+logs_overflowed = 0
 
 
 # Functions
 
-def setup() -> None:
-    """Connects to the client."""
-    load_dotenv()
+class CommandMetrics(pymongo.monitoring.CommandListener):
+    """Record the duration and the failures of every command sent to Mongo."""
+
+    def started(self, event: pymongo.monitoring.CommandStartedEvent) -> None:
+        return
+
+    def succeeded(self, event: pymongo.monitoring.CommandSucceededEvent) -> None:
+        metrics.observe("dependency_seconds", event.duration_micros / 1e6, dependency="mongo",
+                        operation=event.command_name)
+        return
+
+    def failed(self, event: pymongo.monitoring.CommandFailedEvent) -> None:
+        metrics.observe("dependency_seconds", event.duration_micros / 1e6, dependency="mongo",
+                        operation=event.command_name)
+        metrics.inc("dependency_errors_total", dependency="mongo", operation=event.command_name)
+        return
+
+
+def setup(client: motor.motor_asyncio.AsyncIOMotorClient = None) -> None:
+    """Connects to the client, or use the given one (e.g. a local mongod or an in-memory stand-in)."""
     global mongo_client
-    mongo_client = pymongo.MongoClient(env.get_env_variables()["MONGO_URI"])
+    if client is None:
+        client = motor.motor_asyncio.AsyncIOMotorClient(env.get_config().mongo_uri, maxPoolSize=MAX_POOL_SIZE,
+                                                        event_listeners=[CommandMetrics()])
+    mongo_client = client
+    return
+
+
+def _get_db() -> motor.motor_asyncio.AsyncIOMotorDatabase:
+    """Return the database, connecting to the client on first use."""
+    if mongo_client is None:
+        setup()
+    return mongo_client[DATABASE_NAME]
+
+
+# --- INDEXES ---
+
+# Indexes backing the queries made on every interaction, by collection
+INDEXES = {
+    USERS_COLLECTION_NAME: [
+        pymongo.IndexModel([("telegram_id", pymongo.ASCENDING)], unique=True, name="telegram_id_unique"),
+        pymongo.IndexModel([("accred", pymongo.ASCENDING)], name="accred"),
+        pymongo.IndexModel([("expires", pymongo.ASCENDING)], name="expires"),
+        pymongo.IndexModel([("units.expires", pymongo.ASCENDING)], name="units_expires"),
+    ],
+    MESSAGES_COLLECTION_NAME: [
+        pymongo.IndexModel([("copy_id", pymongo.ASCENDING)], name="copy_id"),
+    ],
+}
+
+# (name, collection, filter) of the queries that must never scan a whole collection
+HOT_QUERIES = [
+    ("get_accred / user_exists", USERS_COLLECTION_NAME, {"telegram_id": 0}),
+    ("get_users_by_accred", USERS_COLLECTION_NAME, {"accred": 0}),
+    ("get_users_by_accred_extended", USERS_COLLECTION_NAME, {"accred": {"$gte": 0}}),
+    ("get_original_message", MESSAGES_COLLECTION_NAME, {"copy_id": 0}),
+    ("get_next_expiry (roles)", USERS_COLLECTION_NAME, {"expires": {"$type": "date"}}),
+    ("get_next_expiry (units)", USERS_COLLECTION_NAME, {"units.expires": {"$type": "date"}}),
+]
+
+
+async def ensure_indexes() -> None:
+    """Create the missing indexes, does nothing for the ones that already exist."""
+    db = _get_db()
+    for collection_name, indexes in INDEXES.items():
+        for index in indexes:
+            # One by one, so that an index that cannot be built does not prevent the others
+            try:
+                await db[collection_name].create_indexes([index])
+            except pymongo.errors.PyMongoError as e:
+                # E.g. duplicated telegram ids prevent the unique index, the bot still works without it
+                print(f"Failed to create the index {index.document['name']} of {collection_name}.")
+                print(e)
     return
 
 
+def _plan_stages(plan: any) -> list[str]:
+    """Return all the stages of a query plan, whatever its nesting."""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages += _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += _plan_stages(value)
+    return stages
+
+
+async def audit_indexes() -> list[tuple[str, bool, list[str]]]:
+    """Explain the hot queries and return (name, uses an index, stages of the winning plan) for each of them."""
+    db = _get_db()
+    report = []
+    for name, collection_name, query in HOT_QUERIES:
+        explanation = await db[collection_name].find(query).explain()
+        stages = _plan_stages(explanation["queryPlanner"]["winningPlan"])
+        report.append((name, "COLLSCAN" not in stages, stages))
+    return report
+
+
 # --- USERS ---
 
-def forget_user(user_id: int) -> None:
+def _cache_user(user_id: int, user: dict | None) -> None:
+    """Cache a user document, never beyond the expiracy of its role."""
+    valid_until = time.time() + USER_CACHE_TTL
+    if user is not None and user.get("expires") is not None:
+        valid_until = min(valid_until, user["expires"].timestamp())
+    user_cache[user_id] = (valid_until, user)
+    return
+
+
+def invalidate_user_cache(user_id: int = None) -> None:
+    """Drop a user from the cache, or all users if none is given."""
+    if user_id is None:
+        user_cache.clear()
+    else:
+        user_cache.pop(user_id, None)
+    return
+
+
+async def _get_user(user_id: int) -> dict | None:
+    """Return the document of a user, None if not registered, from the cache when possible."""
+    global user_cache_hits
+    global user_cache_misses
+    cached = user_cache.get(user_id)
+    if cached is not None and cached[0] > time.time():
+        user_cache_hits += 1
+        return cached[1]
+    user_cache_misses += 1
+    db = _get_db()
+    collection = db[USERS_COLLECTION_NAME]
+    user = await collection.find_one({"telegram_id": user_id})
+    _cache_user(user_id, user)
+    return user
+
+
+def user_cache_stats() -> dict[str, int]:
+    """Return the counters of the user cache."""
+    return {
+        'hits': user_cache_hits,
+        'misses': user_cache_misses,
+        'entries': len(user_cache),
+    }
+
+
+async def forget_user(user_id: int) -> None:
     """Remove a user."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[USERS_COLLECTION_NAME]
-    collection.delete_one({"telegram_id": user_id})
+    await collection.delete_one({"telegram_id": user_id})
+    _cache_user(user_id, None)
     return
 
 
-def get_accred(user_id: int) -> int:
+async def get_accred(user_id: int) -> int:
     """Return the accred of a user."""
-    db = mongo_client[DATABASE_NAME]
-    collection = db[USERS_COLLECTION_NAME]
-    user = collection.find_one({"telegram_id": user_id})
+    user = await _get_user(user_id)
     if user is None:
         return -1
     return user["accred"]
 
 
-def has_privilege(user_id: int, privilege: Accred) -> int:
+async def has_privilege(user_id: int, privilege: Accred) -> int:
     """Return the accred of the user. Returns -1 if user could not be found."""
-    accred = get_accred(user_id)
+    accred = await get_accred(user_id)
     if accred == -1:
         return -1
     return Accred(accred) >= privilege
 
 
-def update_accred(user_id: int, accred: Accred) -> None:
+async def update_accred(user_id: int, accred: Accred) -> None:
     """Update the accred of a user."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[USERS_COLLECTION_NAME]
     expires = datetime.datetime.now() + datetime.timedelta(days=DEFAULT_TIME_ROLE)
-    collection.update_one({"telegram_id": user_id}, {"$set": {"accred": accred.value, "expires": expires}})
+    await collection.update_one({"telegram_id": user_id}, {"$set": {"accred": accred.value, "expires": expires}})
+    invalidate_user_cache(user_id)
     return
 
 
-def expire_accreds() -> None:
+async def expire_accreds() -> None:
     """Check expiracy of all users and expire if needed."""
-    db = mongo_client[DATABASE_NAME]
-    collection = db[USERS_COLLECTION_NAME]
-    now = datetime.datetime.now()
-    collection.update_many({"expires": {"$lt": now}}, {"$set": {"accred": Accred.EXTERNAL.value, "expires": None}})
+    await expire_due()
     return
 
 
-def get_users_by_accred(accred: int) -> list[int]:
+async def get_next_expiry() -> datetime.datetime | None:
+    """Return the next time a role or a unit membership expires, None if nothing expires."""
+    db = _get_db()
+    collection = db[USERS_COLLECTION_NAME]
+    deadlines = []
+    user = await collection.find_one({"expires": {"$type": "date"}}, {"expires": 1},
+                                     sort=[("expires", pymongo.ASCENDING)])
+    if user is not None:
+        deadlines.append(user["expires"])
+    # An ascending sort on an array field sorts the documents by their smallest element
+    user = await collection.find_one({"units.expires": {"$type": "date"}}, {"units": 1},
+                                     sort=[("units.expires", pymongo.ASCENDING)])
+    if user is not None:
+        deadlines += [unit["expires"] for unit in user["units"] if isinstance(unit.get("expires"), datetime.datetime)]
+    return min(deadlines, default=None)
+
+
+async def expire_due(now: datetime.datetime = None) -> list[int]:
+    """Expire the roles and unit memberships whose deadline passed, returns the telegram ids of the users affected."""
+    db = _get_db()
+    collection = db[USERS_COLLECTION_NAME]
+    now = now if now is not None else datetime.datetime.now()
+    roles_due = [user["telegram_id"] async for user in
+                 collection.find({"expires": {"$lte": now}}, {"telegram_id": 1})]
+    units_due = [user["telegram_id"] async for user in
+                 collection.find({"units.expires": {"$lte": now}}, {"telegram_id": 1})]
+    operations = [pymongo.UpdateOne({"telegram_id": user_id, "expires": {"$lte": now}},
+                                    {"$set": {"accred": Accred.EXTERNAL.value, "expires": None}})
+                  for user_id in roles_due]
+    operations += [pymongo.UpdateOne({"telegram_id": user_id},
+                                     {"$pull": {"units": {"expires": {"$lte": now}}}})
+                   for user_id in units_due]
+    if operations:
+        await collection.bulk_write(operations, ordered=False)
+    expired = list(set(roles_due) | set(units_due))
+    for user_id in expired:
+        invalidate_user_cache(user_id)
+    return expired
+
+
+async def get_users_by_accred(accred: int) -> list[int]:
     """Return a list of all users with the given accred."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[USERS_COLLECTION_NAME]
-    return [user["telegram_id"] for user in collection.find({"accred": accred})]
+    return [user["telegram_id"] async for user in collection.find({"accred": accred})]
 
 
-def get_users_by_accred_extended(accred: int) -> list[int]:
+async def get_users_by_accred_extended(accred: int) -> list[int]:
     """Return a list of all users with the given accred or higher."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[USERS_COLLECTION_NAME]
-    return [user["telegram_id"] for user in collection.find({"accred": {"$gte": accred}})]
+    return [user["telegram_id"] async for user in collection.find({"accred": {"$gte": accred}})]
 
 
-def user_exists(user_id: int) -> bool:
+async def user_exists(user_id: int) -> bool:
     """Return True if the user exists."""
-    db = mongo_client[DATABASE_NAME]
-    collection = db[USERS_COLLECTION_NAME]
-    return collection.find_one({"telegram_id": user_id}) is not None
+    return await _get_user(user_id) is not None
 
 
-def register_user(user_id: int, first_name: str, last_name: str = None, username: str = None) -> None:
+async def register_user(user_id: int, first_name: str, last_name: str = None, username: str = None) -> None:
     """Register a user."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[USERS_COLLECTION_NAME]
     user = {
         "telegram_id": user_id,
@@ -113,67 +317,97 @@ def register_user(user_id: int, first_name: str, last_name: str = None, username
         "expires": None,
         "units": None
     }
-    collection.insert_one(user)
+    await collection.insert_one(user)
+    _cache_user(user_id, user)
     return
 
 
-def get_user_units(user_id: int) -> list[str]:
+async def get_user_units(user_id: int) -> list[str]:
     """Return the units of a user."""
-    db = mongo_client[DATABASE_NAME]
-    collection = db[USERS_COLLECTION_NAME]
-    user = collection.find_one({"telegram_id": user_id})
+    user = await _get_user(user_id)
     if user is None:
         return []
     return user["units"]
 
 
-def add_user_unit(user_id: int, unit: int) -> None:
+async def add_user_unit(user_id: int, unit: int) -> None:
     """Add a unit to a user."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[USERS_COLLECTION_NAME]
     expires = datetime.datetime.now() + datetime.timedelta(days=DEFAULT_TIME_UNIT)
-    collection.update_one({"telegram_id": user_id}, {"$push": {"units": {"unit": unit, "expires": expires}}})
+    await collection.update_one({"telegram_id": user_id}, {"$push": {"units": {"unit": unit, "expires": expires}}})
+    invalidate_user_cache(user_id)
     return
 
 
 # --- EVENTS ---
 
-def get_event_ids() -> list[str]:
+async def get_event_ids() -> list[str]:
     """Return a list of all event IDs."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[EVENTS_COLLECTION_NAME]
-    return [event["_id"] for event in collection.find()]
+    return [event["_id"] async for event in collection.find()]
 
 
-def add_event_ids(event_ids: list[str]) -> None:
-    """Set the event IDs."""
-    db = mongo_client[DATABASE_NAME]
+async def add_event_ids(events: list[dict]) -> None:
+    """Add event IDs at once, each given as a dict with its "_id" and optionally its "slot" and "fingerprint"."""
+    if not events:
+        return
+    db = _get_db()
     collection = db[EVENTS_COLLECTION_NAME]
-    collection.insert_many([{"_id": event_id} for event_id in event_ids])
+    await collection.insert_many([{"slot": None, "fingerprint": None} | event for event in events])
     return
 
 
-def add_event_id(event_id: str) -> None:
+async def get_events() -> list[dict]:
+    """Return all the events, with the slot they show and the fingerprint of their contents."""
+    db = _get_db()
+    collection = db[EVENTS_COLLECTION_NAME]
+    return await collection.find().to_list(None)
+
+
+async def add_event_id(event_id: str, slot: str = None, fingerprint: str = None) -> None:
     """Add an event ID."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
+    collection = db[EVENTS_COLLECTION_NAME]
+    await collection.insert_one({"_id": event_id, "slot": slot, "fingerprint": fingerprint})
+    return
+
+
+async def update_event_fingerprints(fingerprints: dict[str, str]) -> None:
+    """Update the fingerprints of several events at once, given by event ID."""
+    if not fingerprints:
+        return
+    db = _get_db()
+    collection = db[EVENTS_COLLECTION_NAME]
+    await collection.bulk_write([pymongo.UpdateOne({"_id": event_id}, {"$set": {"fingerprint": fingerprint}})
+                           for event_id, fingerprint in fingerprints.items()])
+    return
+
+
+async def remove_event_ids(event_ids: list[str]) -> None:
+    """Remove event IDs."""
+    if not event_ids:
+        return
+    db = _get_db()
     collection = db[EVENTS_COLLECTION_NAME]
-    collection.insert_one({"_id": event_id})
+    await collection.delete_many({"_id": {"$in": event_ids}})
     return
 
 
-def clear_event_ids() -> None:
+async def clear_event_ids() -> None:
     """Clear the event IDs."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[EVENTS_COLLECTION_NAME]
-    collection.delete_many({})
+    await collection.delete_many({})
     return
 
 
 # --- MESSAGES ---
 
-def add_message(original_id: int, copy_id: int, chat_id: int, text: str, reply_to_message_id: int = None) -> None:
+async def add_message(original_id: int, copy_id: int, chat_id: int, text: str, reply_to_message_id: int = None) -> None:
     """Push a message to the database."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[MESSAGES_COLLECTION_NAME]
     message = {
         "original_id": original_id,
@@ -183,32 +417,39 @@ def add_message(original_id: int, copy_id: int, chat_id: int, text: str, reply_t
         "text": text,
         "date": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
     }
-    collection.insert_one(message)
+    # Remembered before the insert, so a reply can find the message while it is still being written
+    recent_messages[copy_id] = message
+    while len(recent_messages) > RECENT_MESSAGES_SIZE:
+        recent_messages.popitem(last=False)
+    await collection.insert_one(message)
     return
 
 
-def get_original_message(copy_id: int) -> dict:
-    """Return the original message."""
-    db = mongo_client[DATABASE_NAME]
+async def get_original_message(copy_id: int) -> dict:
+    """Return the original message, from memory if it was relayed recently."""
+    if copy_id in recent_messages:
+        return recent_messages[copy_id]
+    db = _get_db()
     collection = db[MESSAGES_COLLECTION_NAME]
-    return collection.find_one({"copy_id": copy_id})
+    return await collection.find_one({"copy_id": copy_id})
 
 
-def clear_messages() -> None:
+async def clear_messages() -> None:
     """Clear the messages."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[MESSAGES_COLLECTION_NAME]
-    collection.delete_many({})
+    recent_messages.clear()
+    await collection.delete_many({})
     return
 
 
 # --- UNITS ---
 
-def add_unit(name: str) -> int:
+async def add_unit(name: str) -> int:
     """Add a unit, set id to last one + 1 and returns the id."""
-    db = mongo_client[DATABASE_NAME]
+    db = _get_db()
     collection = db[UNITS_COLLECTION_NAME]
-    last_unit = collection.find_one(sort=[("_id", -1)])
+    last_unit = await collection.find_one(sort=[("_id", -1)])
     if last_unit is None:
         unit_id = 1
     else:
@@ -217,22 +458,33 @@ def add_unit(name: str) -> int:
         "_id": unit_id,
         "name": name,
     }
-    collection.insert_one(unit)
+    await collection.insert_one(unit)
     return unit_id
 
 
 # --- LOGS ---
 
 def log(user_id: int, text: str, type: str) -> None:
-    """Log content to the db."""
-    db = mongo_client[DATABASE_NAME]
-    collection = db[LOGS_COLLECTION_NAME]
+    """Queue content to be logged to the db, without waiting for the db."""
+    global logs_dropped
+    global logs_overflowed
     log = {
         "user_id": user_id,
         "text": text,
-        "type": type
+        "type": type,
+        "date": datetime.datetime.now(),
     }
-    collection.insert_one(log)
+    if log_queue.full():
+        # Keep one entry out of LOG_SAMPLE_RATE while the db cannot keep up, or none with the drop policy
+        logs_overflowed += 1
+        if LOG_OVERFLOW_POLICY == LOG_OVERFLOW_DROP or logs_overflowed % LOG_SAMPLE_RATE != 0:
+            logs_dropped += 1
+            return
+        log_queue.get_nowait()
+        logs_dropped += 1
+    log_queue.put_nowait(log)
+    if log_queue.qsize() >= LOG_FLUSH_SIZE:
+        log_flush_needed.set()
     return
 
 
@@ -249,3 +501,66 @@ def log_command(user_id: int, text: str) -> None:
 def log_callback(user_id: int, callback_data: str) -> None:
     log(user_id, callback_data, "callback")
     return
+
+
+async def flush_logs() -> None:
+    """Write all the queued logs to the db at once."""
+    global logs_written
+    global logs_dropped
+    logs = []
+    while not log_queue.empty():
+        logs.append(log_queue.get_nowait())
+    if not logs:
+        return
+    db = _get_db()
+    collection = db[LOGS_COLLECTION_NAME]
+    try:
+        await collection.insert_many(logs, ordered=False)
+        logs_written += len(logs)
+    except Exception as e:
+        logs_dropped += len(logs)
+        print(f"Failed to write {len(logs)} logs.")
+        print(e)
+    return
+
+
+async def _flush_logs_forever() -> None:
+    """Flush the logs every LOG_FLUSH_INTERVAL seconds, or as soon as LOG_FLUSH_SIZE logs are queued."""
+    while True:
+        try:
+            await asyncio.wait_for(log_flush_needed.wait(), LOG_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        log_flush_needed.clear()
+        await flush_logs()
+
+
+def start_log_flusher() -> None:
+    """Start writing the queued logs in the background."""
+    global log_flusher
+    if log_flusher is None or log_flusher.done():
+        log_flusher = asyncio.create_task(_flush_logs_forever())
+    return
+
+
+async def stop_log_flusher() -> None:
+    """Stop the background writing and write the logs still queued."""
+    global log_flusher
+    if log_flusher is not None:
+        log_flusher.cancel()
+        try:
+            await log_flusher
+        except asyncio.CancelledError:
+            pass
+        log_flusher = None
+    await flush_logs()
+    return
+
+
+def log_stats() -> dict[str, int]:
+    """Return the counters of the log queue."""
+    return {
+        'queued': log_queue.qsize(),
+        'written': logs_written,
+        'dropped': logs_dropped,
+    }
@@ -1,3 +1,4 @@
+import asyncio
 import json
 
 import truffe
@@ -15,7 +16,7 @@ def save_truffe_to_JSON():
     """Saves the truffe object to a JSON file"""
     # save JSON to file
     with open('debug/truffe.json', 'w') as f:
-        json.dump(truffe._get_json_from_truffe(), f, indent=4)
+        json.dump(asyncio.run(truffe._fetch_json_from_truffe()), f, indent=4)
 
 
 if __name__ == '__main__':
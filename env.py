@@ -1,23 +1,59 @@
 import ast
+import dataclasses
+import functools
 import os
 
 from dotenv import load_dotenv
 
 
-def get_env_variables() -> dict[str, str]:
-    """Get environment variables from .env file."""
+def _int_or_none(value: str | None) -> int | None:
+    return int(value) if value else None
+
+
+@dataclasses.dataclass(frozen=True)
+class Config:
+    """Configuration of the bot, read once from the environment."""
+    env: str | None
+    heroku_path: str | None
+    token: str | None
+    truffe_token: str | None
+    calendar_id: str | None
+    gservice_credentials_raw: str | None
+    mongo_uri: str | None
+    support_group_id: int | None
+    maintainers_group_id: int | None
+    update_trace_path: str | None
+    update_workers: int | None
+    metrics_token: str | None
+    pdf_workers: int | None
+
+    @functools.cached_property
+    def gservice_credentials(self) -> dict | None:
+        """The Google service account credentials, only parsed when the calendar is used."""
+        if self.gservice_credentials_raw is None:
+            return None
+        return ast.literal_eval(self.gservice_credentials_raw)
+
+
+@functools.cache
+def get_config() -> Config:
+    """Get the configuration from the environment and the .env file, only loaded on the first call."""
     load_dotenv()
-    return {
-        'ENV': os.getenv('ENV'),
-        'HEROKU_PATH': os.getenv('HEROKU_PATH'),
-        'TOKEN': os.environ.get('TOKEN'),
-        'TRUFFE_TOKEN': os.environ.get('TRUFFE_TOKEN'),
-        'CALENDAR_ID': os.environ.get('CALENDAR_ID'),
-        'GSERVICE_CREDENTIALS': ast.literal_eval(os.environ.get('GSERVICE_CREDENTIALS')),
-        'MONGO_URI': os.environ.get('MONGO_URI'),
-        'SUPPORT_GROUP_ID': int(os.environ.get('SUPPORT_GROUP_ID')),
-        'MAINTAINERS_GROUP_ID': int(os.environ.get('MAINTAINERS_GROUP_ID'))
-    }
+    return Config(
+        env=os.getenv('ENV'),
+        heroku_path=os.getenv('HEROKU_PATH'),
+        token=os.environ.get('TOKEN'),
+        truffe_token=os.environ.get('TRUFFE_TOKEN'),
+        calendar_id=os.environ.get('CALENDAR_ID'),
+        gservice_credentials_raw=os.environ.get('GSERVICE_CREDENTIALS'),
+        mongo_uri=os.environ.get('MONGO_URI'),
+        support_group_id=_int_or_none(os.environ.get('SUPPORT_GROUP_ID')),
+        maintainers_group_id=_int_or_none(os.environ.get('MAINTAINERS_GROUP_ID')),
+        update_trace_path=os.environ.get('UPDATE_TRACE_PATH'),
+        update_workers=_int_or_none(os.environ.get('UPDATE_WORKERS')),
+        metrics_token=os.environ.get('METRICS_TOKEN'),
+        pdf_workers=_int_or_none(os.environ.get('PDF_WORKERS')),
+    )
 
 
 def store_env_variable(variable: str, value: any) -> None:
@@ -0,0 +1,41 @@
+import datetime
+
+import pymongo.errors
+from telegram.ext import CallbackContext, JobQueue
+
+import database
+
+JOB_NAME = "expire_due"
+MAX_SLEEP = 6 * 3600  # seconds, also catches the deadlines written by other processes
+RETRY_DELAY = 60  # seconds before trying again when the db failed
+
+
+async def expire_job(context: CallbackContext) -> None:
+    """Expire what is due, then sleep until the next deadline."""
+    try:
+        expired = await database.expire_due()
+    except Exception:
+        context.job_queue.run_once(expire_job, RETRY_DELAY, name=JOB_NAME)
+        raise
+    if expired:
+        print(f"Expired the roles or units of {len(expired)} users.")
+    await schedule(context.job_queue)
+    return
+
+
+async def schedule(job_queue: JobQueue) -> None:
+    """(Re)schedule the expiry job at the next deadline, to call whenever a deadline may have changed."""
+    try:
+        deadline = await database.get_next_expiry()
+        delay = MAX_SLEEP
+        if deadline is not None:
+            delay = min(max((deadline - datetime.datetime.now()).total_seconds(), 0), MAX_SLEEP)
+    except pymongo.errors.PyMongoError as e:
+        # E.g. Mongo unreachable at boot: the bot starts anyway and the job looks for the deadline again later
+        print("Failed to find the next expiry.")
+        print(e)
+        delay = RETRY_DELAY
+    for job in job_queue.get_jobs_by_name(JOB_NAME):
+        job.schedule_removal()
+    job_queue.run_once(expire_job, delay, name=JOB_NAME)
+    return
@@ -1,4 +1,7 @@
+import startup  # first import, so that the startup report includes the import time of everything else
+
 import argparse
+import asyncio
 import html
 import io
 import json
@@ -8,26 +11,42 @@ import traceback
 
 from telegram import Update, constants
 from telegram.constants import ParseMode
-from telegram.ext import CallbackContext, CommandHandler, Application, CallbackQueryHandler, filters, MessageHandler
+from telegram.ext import CallbackContext, CommandHandler, Application, CallbackQueryHandler, filters, MessageHandler, \
+    TypeHandler
+from telegram.request import BaseRequest
 
+import calendarjobs
 import database
+import expiry
 import managecalendar
+import metrics
+import outbox
 import mytelegram
+import pdfbundles
+import pdfcache
+import pdfmerge
+import tracing
 import truffe
+import truffeclient
+import updateprocessor
+import webserver
 import weekdays
 from accred import Accred
-from env import get_env_variables
+from env import get_config
+from mytelegram import DEFAULT_CONTACT
+
+startup.mark("imports")
 
 PORT = int(os.environ.get('PORT', 5000))
-ENV = get_env_variables()['ENV']
-HEROKU_PATH = get_env_variables()['HEROKU_PATH']
-TOKEN = get_env_variables()['TOKEN']
-SUPPORT_GROUP_ID = get_env_variables()['SUPPORT_GROUP_ID']
-MAINTAINERS_GROUP_ID = get_env_variables()['MAINTAINERS_GROUP_ID']
+ENV = get_config().env
+HEROKU_PATH = get_config().heroku_path
+TOKEN = get_config().token
+SUPPORT_GROUP_ID = get_config().support_group_id
+MAINTAINERS_GROUP_ID = get_config().maintainers_group_id
 
 RESERVATION_MENU_MESSAGE = "Choisissez une reservation :"
-
-DEFAULT_CONTACT = "logistique@agepoly.ch"
+RESERVATION_NOT_FOUND_MESSAGE = "Cette réservation n'existe plus sur Truffe."
+CALENDAR_BUSY_MESSAGE = "Une autre opération sur le calendrier est en cours, merci de réessayer quand elle sera finie."
 
 commands = {
     "start": {"description": "Point d'entrée du bot, indispensable pour l'utiliser", "accred": Accred.NONE},
@@ -41,6 +60,7 @@ commands = {
                            "sélection de slot passés (old)", "accred": Accred.TEAM_MEMBER},
     "calendar": {"description": "Actualiser le calendrier", "accred": Accred.TEAM_LEADER},
     "clearcalendar": {"description": "Vider le calendrier", "accred": Accred.TEAM_LEADER},
+    "stats": {"description": "Voir l'état des caches du bot", "accred": Accred.ADMIN},
 }
 
 
@@ -52,14 +72,14 @@ async def not_in_group(update: Update) -> bool:
         await update.message.reply_text("Cette commande ne peut être utilisée que dans un échange privé avec le bot.")
         return False
 
-def can_use_command(update: Update, accred: Accred) -> bool:
+async def can_use_command(update: Update, accred: Accred) -> bool:
     """Check if the user can use the command."""
-    return database.has_privilege(update.effective_user.id, accred) > 0
+    return (await database.has_privilege(update.effective_user.id, accred)) > 0
 
 
 async def warn_cannot_use_command(update: Update, accred: Accred, context: CallbackContext = None) -> None:
     """Warn the user that he cannot use this command."""
-    can_use = database.has_privilege(update.effective_user.id, accred)
+    can_use = await database.has_privilege(update.effective_user.id, accred)
     text = ""
     if can_use == -1:
         text += "Tu n'es pas enregistré·e. Merci d'utiliser /start pour t'enregistrer\n"
@@ -88,8 +108,8 @@ async def start(update: Update, context: CallbackContext) -> any:
     """Send a message when the command /start is issued."""
     database.log_command(update.effective_user.id, update.message.text)
     user_id = update.message.from_user.id
-    if not database.user_exists(user_id):
-        database.register_user(user_id, update.effective_user.first_name, update.effective_user.last_name,
+    if not await database.user_exists(user_id):
+        await database.register_user(user_id, update.effective_user.first_name, update.effective_user.last_name,
                                update.effective_user.username)
     text = "Bonjour ! Je suis le bot de l'Équipe Logistique de l'AGEPoly,\n"
     text += "Je sers de point de contact centralisé pour toutes vos questions et remarques concernant la logistique opérationnelle de l'AGEPoly.\n"
@@ -104,10 +124,10 @@ async def forget(update: Update, context: CallbackContext) -> any:
     database.log_command(update.effective_user.id, update.message.text)
     if not await not_in_group(update):
         return
-    if not can_use_command(update, commands["forget"]["accred"]):
+    if not await can_use_command(update, commands["forget"]["accred"]):
         await warn_cannot_use_command(update, commands["forget"]["accred"])
         return
-    database.forget_user(update.effective_user.id)
+    await database.forget_user(update.effective_user.id)
     await update.message.reply_text("You have been forgotten. You can now use /start to get registered again.")
     return
 
@@ -115,12 +135,13 @@ async def forget(update: Update, context: CallbackContext) -> any:
 async def help_command(update: Update, context: CallbackContext) -> any:
     """Send a message when the command /help is issued."""
     database.log_command(update.effective_user.id, update.message.text)
-    if not can_use_command(update, commands["help"]["accred"]):
+    if not await can_use_command(update, commands["help"]["accred"]):
         await warn_cannot_use_command(update, commands["help"]["accred"])
         return
     text = "Here is a list of all the commands you can use:\n"
-    for command in filter(lambda x: can_use_command(update, commands[x]["accred"]), commands):
-        text += f"/{command} - {commands[command]['description']}\n"
+    for command in commands:
+        if await can_use_command(update, commands[command]["accred"]):
+            text += f"/{command} - {commands[command]['description']}\n"
     await update.message.reply_text(text)
     return
 
@@ -130,7 +151,7 @@ async def contact_command(update: Update, context: CallbackContext) -> any:
     database.log_command(update.effective_user.id, update.message.text)
     if not await not_in_group(update):
         return
-    if not can_use_command(update, commands["contact"]["accred"]):
+    if not await can_use_command(update, commands["contact"]["accred"]):
         await warn_cannot_use_command(update, commands["contact"]["accred"])
         return
     await update.message.reply_text(
@@ -145,55 +166,76 @@ async def handle_messages(update: Update, context: CallbackContext) -> any:
     if update.message is not None and update.message.text is not None and re.match(pattern, update.message.text):
         return await invalid_command(update, context)
 
+    with metrics.timer("relay_seconds", stage="total"):
+        await _relay_message(update, context)
+    return
+
+
+async def _relay_message(update: Update, context: CallbackContext) -> None:
+    """Relay a message between a user and the support group, with a single request to Telegram."""
+    message = update.message if update.message is not None else update.edited_message
     if update.message is not None:
         database.log_message(update.effective_user.id, update.message.text)
+    reply_to = message.reply_to_message
+    # The registration and the replied message are independent, look them up together
+    with metrics.timer("relay_seconds", stage="lookup"):
+        lookups = [database.user_exists(update.effective_user.id)]
+        if reply_to is not None:
+            lookups.append(database.get_original_message(reply_to.id))
+        registered, *original_message = await asyncio.gather(*lookups)
+    original_message = original_message[0] if original_message else None
     # If the user is not registered, he cannot use the bot
-    if not database.user_exists(update.effective_user.id):
-        await update.message.reply_text(
+    if not registered:
+        await message.reply_text(
             "Il faut être enregistré·e pour pouvoir discuter avec nous ! Merci d'utiliser /start pour t'enregistrer")
         return
-    # If the message is an answer to a contact message, send it back to the user
-    message = update.message if update.message is not None else update.edited_message
-    reply_to = message.reply_to_message
 
+    # If the message is an answer to a contact message, send it back to the user
     if message.chat_id == SUPPORT_GROUP_ID:
-        original_message = database.get_original_message(reply_to.id) if reply_to is not None else None
         if original_message is not None:
-            copy_message_id = (await message.copy(chat_id=original_message["chat_id"],
-                                                  reply_to_message_id=original_message["original_id"])).message_id
-            database.add_message(message.id, copy_message_id, message.chat_id, message.text, reply_to.id)
-        elif message.chat_id != SUPPORT_GROUP_ID:
-            if message is not None:
-                await message.reply_text(
-                "Je n'ai pas retrouvé le message original et ne peux donc pas transmettre la réponse :(")
-            else:
-                await update.edited_message.reply_text(
-                    "Je n'ai pas retrouvé le message original et ne peux donc pas transmettre la réponse :(")
-    else:
-        original_message_id = None
-        if reply_to is not None:
-            original_message_id = database.get_original_message(reply_to.id)["original_id"]
-        if message.text is not None:
-            # If there is text, we can edit it
+            with metrics.timer("relay_seconds", stage="send"):
+                copy_message_id = (await message.copy(chat_id=original_message["chat_id"],
+                                                      reply_to_message_id=original_message["original_id"])).message_id
+            _store_relayed_message(context, update, message.id, copy_message_id, message.chat_id, message.text,
+                                   reply_to.id)
+        return
+
+    original_message_id = original_message["original_id"] if original_message is not None else None
+    if message.text is not None:
+        # The header and the text are sent together, instead of copying the message and editing it
+        text = f"<b>{html.escape(message.from_user.first_name)} {html.escape(message.from_user.last_name if message.from_user.last_name else '')}</b> {html.escape('(@'+message.from_user.username+')' if message.from_user.username else '')}\n{html.escape(message.text)}"
+        with metrics.timer("relay_seconds", stage="send"):
+            copy_message_id = (await context.bot.send_message(chat_id=SUPPORT_GROUP_ID, text=text,
+                                                              parse_mode=ParseMode.HTML,
+                                                              reply_to_message_id=original_message_id,
+                                                              allow_sending_without_reply=True,
+                                                              #reply_markup=mytelegram.get_close_ticket_keyboard(update)
+                                                              )).message_id
+        _store_relayed_message(context, update, message.id, copy_message_id, message.chat_id, message.text,
+                               reply_to.id if reply_to else None)
+    elif original_message_id is not None:
+        # If there is no text, we cannot add the header and have to forward the message if we are not replying
+        with metrics.timer("relay_seconds", stage="send"):
             copy_message_id = (await message.copy(chat_id=SUPPORT_GROUP_ID,
                                                   reply_to_message_id=original_message_id)).message_id
-            text = f"<b>{html.escape(message.from_user.first_name)} {html.escape(message.from_user.last_name if message.from_user.last_name else '')}</b> {html.escape('(@'+message.from_user.username+')' if message.from_user.username else '')}\n{html.escape(message.text)}"
-            await context.bot.edit_message_text(chat_id=SUPPORT_GROUP_ID, message_id=copy_message_id,
-                                                text=text, parse_mode=ParseMode.HTML,
-                                                #reply_markup=mytelegram.get_close_ticket_keyboard(update)
-                                                )
-            database.add_message(message.id, copy_message_id, message.chat_id, message.text,
-                                 reply_to.id if reply_to else None)
-        else:
-            # If there is no text, we cannot edit it and have to forward the message if we are not replying
-            if original_message_id is not None:
-                copy_message_id = (await message.copy(chat_id=SUPPORT_GROUP_ID,
-                                                      reply_to_message_id=original_message_id)).message_id
-                database.add_message(message.id, copy_message_id, message.chat_id, None,
-                                     reply_to.id)
-            else:
-                new_message_id = (await message.forward(chat_id=SUPPORT_GROUP_ID)).id
-                database.add_message(message.id, new_message_id, message.chat_id, None)
+        _store_relayed_message(context, update, message.id, copy_message_id, message.chat_id, None, reply_to.id)
+    else:
+        with metrics.timer("relay_seconds", stage="send"):
+            new_message_id = (await message.forward(chat_id=SUPPORT_GROUP_ID)).id
+        _store_relayed_message(context, update, message.id, new_message_id, message.chat_id, None)
+    return
+
+
+def _store_relayed_message(context: CallbackContext, update: Update, original_id: int, copy_id: int, chat_id: int,
+                           text: str | None, reply_to_message_id: int = None) -> None:
+    """Write the relayed message in the background, the relay does not wait for the database."""
+    async def store() -> None:
+        with metrics.timer("relay_seconds", stage="store"):
+            await database.add_message(original_id, copy_id, chat_id, text, reply_to_message_id)
+        return
+
+    # Errors of the task go to the error handler, like the errors of the handlers
+    context.application.create_task(store(), update=update)
     return
 
 
@@ -202,7 +244,7 @@ async def join(update: Update, context: CallbackContext) -> any:
     database.log_command(update.effective_user.id, update.message.text)
     if not await not_in_group(update):
         return
-    if not can_use_command(update, commands["join"]["accred"]):
+    if not await can_use_command(update, commands["join"]["accred"]):
         await warn_cannot_use_command(update, commands["join"]["accred"])
         return
     text = "Si tu es un·e membre d'une équipe ou CdD, tu peux avoir accès à plus de commandes avec ce bot !\n"
@@ -218,10 +260,10 @@ async def get_reservations(update: Update, context: CallbackContext) -> any:
     database.log_command(update.effective_user.id, update.message.text)
     if not await not_in_group(update):
         return
-    if not can_use_command(update, commands["reservations"]["accred"]):
+    if not await can_use_command(update, commands["reservations"]["accred"]):
         await warn_cannot_use_command(update, commands["reservations"]["accred"])
         return
-    keyboard, page = mytelegram.get_reservations_keyboard(truffe.DEFAULT_ACCEPTED_STATES, 0)
+    keyboard, page = await mytelegram.get_reservations_keyboard(truffe.DEFAULT_ACCEPTED_STATES, 0)
     await update.message.reply_text(f"{RESERVATION_MENU_MESSAGE} (page {page + 1})", reply_markup=keyboard)
     return
 
@@ -231,7 +273,7 @@ async def get_pdf(update: Update, context: CallbackContext) -> any:
     database.log_command(update.effective_user.id, update.message.text)
     if not await not_in_group(update):
         return
-    if not can_use_command(update, commands["pdf"]["accred"]):
+    if not await can_use_command(update, commands["pdf"]["accred"]):
         await warn_cannot_use_command(update, commands["pdf"]["accred"])
         return
 
@@ -255,15 +297,27 @@ async def get_pdf(update: Update, context: CallbackContext) -> any:
             if wd is not None:
                 day = int(wd)
 
+    date, morning = truffe.get_half_day(day, mor, fut)
+    res_list = await truffe.get_reservations_half_day(states, date, morning)
+    if len(res_list) == 0:
+        await update.message.reply_text("Il n'y a pas de réservations pour cette demi-journée.")
+        return
+
+    # The current and next half days are prepared in the background by refresh_pdf_bundles
+    bundle = pdfbundles.get(date, morning, states, res_list)
+    if bundle is not None:
+        message = await update.message.reply_document(
+            bundle.file_id or bundle.content, filename="agreements.pdf",
+            reply_markup=mytelegram.delete_message_keyboard(update, "Supprimer le PDF"))
+        if message.document is not None:
+            bundle.file_id = message.document.file_id
+        return
+
     # response to the user and pdf generation
     wait_message = await update.message.reply_text("PDF en génération. Merci de patienter...")
-    pks_list = list(map(lambda res: res['pk'], truffe.get_reservations_half_day(states, day, mor, fut)))
-    if len(pks_list) > 0:
-        agreements = truffe.get_agreements_pdf_merged_from_pks(pks_list)
-        await update.message.reply_document(agreements, filename="agreements.pdf",
-                                            reply_markup=mytelegram.delete_message_keyboard(update, "Supprimer le PDF"))
-    else:
-        await update.message.reply_text("Il n'y a pas de réservations pour cette demi-journée.")
+    agreements = await truffe.get_agreements_pdf_merged_from_pks([res.pk for res in res_list])
+    await update.message.reply_document(agreements, filename="agreements.pdf",
+                                        reply_markup=mytelegram.delete_message_keyboard(update, "Supprimer le PDF"))
     await wait_message.delete()
 
 
@@ -272,14 +326,12 @@ async def update_calendar(update: Update, context: CallbackContext) -> any:
     database.log_command(update.effective_user.id, update.message.text)
     if not await not_in_group(update):
         return
-    if not can_use_command(update, commands["calendar"]["accred"]):
+    if not await can_use_command(update, commands["calendar"]["accred"]):
         await warn_cannot_use_command(update, commands["calendar"]["accred"])
         return
-    done = managecalendar.refresh_calendar(truffe.get_reservations())
-    if done:
-        await update.message.reply_text('Le calendrier a été mis à jour! 📅')
-    else:
-        await update.message.reply_text('Erreur lors de la mise à jour du calendrier. 😢')
+    job = await calendarjobs.submit(context.application, calendarjobs.REFRESH, update.message, update)
+    if job is None:
+        await update.message.reply_text(CALENDAR_BUSY_MESSAGE)
     return
 
 
@@ -288,17 +340,81 @@ async def clear_calendar(update: Update, context: CallbackContext) -> any:
     database.log_command(update.effective_user.id, update.message.text)
     if not await not_in_group(update):
         return
-    if not can_use_command(update, commands["clearcalendar"]["accred"]):
+    if not await can_use_command(update, commands["clearcalendar"]["accred"]):
         await warn_cannot_use_command(update, commands["clearcalendar"]["accred"])
         return
-    done = managecalendar.clear_calendar()
-    if done:
-        await update.message.reply_text('Le calendrier a été vidé! 📅')
-    else:
-        await update.message.reply_text('Erreur lors du vidage du calendrier. 😢')
+    job = await calendarjobs.submit(context.application, calendarjobs.CLEAR, update.message, update)
+    if job is None:
+        await update.message.reply_text(CALENDAR_BUSY_MESSAGE)
     return
 
 
+async def stats_command(update: Update, context: CallbackContext) -> any:
+    """Executed when the command /stats is issued, usable in the maintainers group."""
+    database.log_command(update.effective_user.id, update.message.text)
+    if not await can_use_command(update, commands["stats"]["accred"]):
+        await warn_cannot_use_command(update, commands["stats"]["accred"])
+        return
+    truffe_info = truffe.cache_info()
+    pdf_info = pdfcache.stats()
+    text = "<b>Cache Truffe</b>\n"
+    text += f"Version : {truffe_info['version']}\n"
+    text += f"Âge : {_format_seconds(truffe_info['age'])}\n"
+    text += f"Réservations : {truffe_info['reservations']}\n"
+    text += f"Actualisation en cours : {'oui' if truffe_info['refreshing'] else 'non'}\n"
+    text += f"Durée de la dernière actualisation : {_format_seconds(truffe_info['last_refresh_duration'])}\n"
+    if truffe_info['last_refresh_error'] is not None:
+        text += f"Dernière erreur : {html.escape(truffe_info['last_refresh_error'])}\n"
+    text += "\n<b>Cache des conventions</b>\n"
+    text += f"Hits / misses : {pdf_info['hits']} / {pdf_info['misses']}\n"
+    text += f"Entrées : {pdf_info['entries']} ({pdf_info['size'] / 1024 / 1024:.1f} Mo)\n"
+    text += f"Évictions : {pdf_info['evictions']}\n"
+    user_info = database.user_cache_stats()
+    text += "\n<b>Cache des utilisateurs</b>\n"
+    text += f"Hits / misses : {user_info['hits']} / {user_info['misses']}\n"
+    text += f"Entrées : {user_info['entries']}\n"
+    log_info = database.log_stats()
+    text += "\n<b>Logs</b>\n"
+    text += f"En attente / écrits / perdus : {log_info['queued']} / {log_info['written']} / {log_info['dropped']}\n"
+    for title, name in [("Commandes", "handler_seconds"), ("Services externes", "dependency_seconds"),
+                        ("Relais du support", "relay_seconds")]:
+        latencies = metrics.summary(name)
+        if latencies:
+            text += f"\n<b>{title}</b>\n"
+            for labels, info in latencies.items():
+                text += (f"{html.escape(labels)} : {info['count']} fois, moyenne {_format_seconds(info['mean'])}, "
+                         f"p95 ≤ {_format_seconds(info['p95'])}\n")
+    text += "\n<b>Taux de hits</b>\n"
+    for cache in ["truffe", "reservation_pages", "agreements", "pdf_bundles", "users"]:
+        hits = metrics.value("cache_hits_total", cache=cache) or 0
+        misses = metrics.value("cache_misses_total", cache=cache) or 0
+        text += f"{cache} : {hits / (hits + misses):.0%}\n" if hits + misses else f"{cache} : -\n"
+    text += f"\nLatence de la boucle d'événements : {_format_seconds(metrics.event_loop_lag)}\n"
+    if isinstance(context.application.update_processor, updateprocessor.PerChatUpdateProcessor):
+        processor_info = context.application.update_processor.stats()
+        text += (f"Updates : {processor_info['running']} / {processor_info['workers']} en cours, "
+                 f"{processor_info['pending']} en attente dans {processor_info['chats']} chats "
+                 f"(max {processor_info['max_chat_depth']} dans un chat)\n")
+    if isinstance(context.bot.rate_limiter, outbox.PriorityRateLimiter):
+        outbox_info = context.bot.rate_limiter.stats()
+        text += "\n<b>Envois Telegram</b>\n"
+        for name in outbox.PRIORITY_NAMES.values():
+            text += (f"{name} : {outbox_info['queued'][name]} en attente (max {outbox_info['max_queued'][name]}), "
+                     f"{outbox_info['sent'][name]} envoyés\n")
+        text += f"Retry after : {outbox_info['retries']}\n"
+    text += "\n<b>Démarrage</b>\n"
+    text += html.escape(startup.report()) + "\n"
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    return
+
+
+def _format_seconds(seconds: float | None) -> str:
+    """Format a duration for the maintainers."""
+    if seconds is None:
+        return "-"
+    return f"{seconds:.2f} s"
+
+
 async def manage_external_callbacks(update: Update, context: CallbackContext, args: list[str]) -> bool:
     """Manage the callback queries from the external users."""
     query = update.callback_query
@@ -311,15 +427,18 @@ async def manage_external_callbacks(update: Update, context: CallbackContext, ar
             await query.edit_message_text("Merci pour ta demande ! Ton rôle sera modéré au plus vite !")
     elif args[0] == "ok":
         requester_id = int(args[2])
-        database.update_accred(requester_id, Accred(int(args[1])))
+        await database.update_accred(requester_id, Accred(int(args[1])))
+        await expiry.schedule(context.job_queue)
         await query.edit_message_text("Le rôle a été modifié !")
         await context.bot.send_message(chat_id=requester_id,
-                                       text="Ta demande a été acceptée et ton rôle a été modifié !")
+                                       text="Ta demande a été acceptée et ton rôle a été modifié !",
+                                       rate_limit_args=outbox.NOTIFICATION)
     elif args[0] == "no":
         await context.bot.send_message(chat_id=int(args[2]),
                                        text=f"Ta demande d'accréditation en tant que {Accred(int(args[1]))} a été "
                                             f"refusée. Si tu penses qu'il s'agit d'une erreur tu peux nous contacter "
-                                            f"avec /contact !")
+                                            f"avec /contact !",
+                                       rate_limit_args=outbox.NOTIFICATION)
         await query.edit_message_text("Le rôle reste inchangé. La personne qui a fait la demande a été prévenue.")
     elif args[0] == "delete":
         await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
@@ -334,7 +453,7 @@ async def manage_log_callbacks(update: Update, context: CallbackContext, args: l
     if args[0] == "reservations":
         state = args[1]
         state_list = truffe.DEFAULT_ACCEPTED_STATES if state == "def" else truffe.EXTENDED_ACCEPTED_STATES
-        keyboard, page = mytelegram.get_reservations_keyboard(states=state_list,
+        keyboard, page = await mytelegram.get_reservations_keyboard(states=state_list,
                                                               page=int(args[2]),
                                                               displaying_all_res=(state == "all"))
         await query.edit_message_text(text=f"{RESERVATION_MENU_MESSAGE} (page {page + 1})", reply_markup=keyboard)
@@ -342,18 +461,23 @@ async def manage_log_callbacks(update: Update, context: CallbackContext, args: l
         state = args[1]
         state_list = truffe.DEFAULT_ACCEPTED_STATES if state == "def" else truffe.EXTENDED_ACCEPTED_STATES
         page = int(args[2])
-        keyboard, page = mytelegram.get_reservations_keyboard(state_list, page, displaying_all_res=(state == "all"))
+        keyboard, page = await mytelegram.get_reservations_keyboard(state_list, page, displaying_all_res=(state == "all"))
         await query.edit_message_text(text=f"{RESERVATION_MENU_MESSAGE} (page {page + 1})", reply_markup=keyboard)
     elif args[0].isdigit():
         pk = int(args[0])
-        text = truffe.get_formatted_reservation_relevant_info_from_pk(pk)
+        text = await truffe.get_formatted_reservation_relevant_info_from_pk(pk)
+        if text is None:
+            await query.edit_message_text(text=RESERVATION_NOT_FOUND_MESSAGE,
+                                          reply_markup=mytelegram.get_back_to_reservations_keyboard(
+                                              page=int(args[2]), displaying_all_res=(args[1] == "all")))
+            return True
         await query.edit_message_text(text=text, parse_mode=constants.ParseMode.MARKDOWN_V2,
                                       reply_markup=mytelegram.get_one_res_keyboard(pk,
                                                                                    page=int(args[2]),
                                                                                    displaying_all_res=(args[1] == "all")))
     elif args[0] == "agreement":
         pk = int(args[1])
-        document = io.BytesIO(truffe.get_agreement_pdf_from_pk(pk))
+        document = io.BytesIO(await truffe.get_agreement_pdf_from_pk(pk))
         await context.bot.send_document(chat_id=query.message.chat_id, document=document, filename='agreement.pdf', reply_markup=mytelegram.delete_message_keyboard(update, "Supprimer le PDF"))
     else:
         return False
@@ -367,10 +491,10 @@ async def callback_query_handler(update: Update, context: CallbackContext) -> an
     await query.answer()
 
     args = query.data.split('_')
-    if can_use_command(update, Accred.EXTERNAL):
+    if await can_use_command(update, Accred.EXTERNAL):
         if await manage_external_callbacks(update, context, args):
             return
-    if can_use_command(update, Accred.TEAM_MEMBER):
+    if await can_use_command(update, Accred.TEAM_MEMBER):
         if await manage_log_callbacks(update, context, args):
             return
     text = "Cette fonctionnalité n'est pas implémentée ou tu n'as plus les droits pour utiliser ce menu.\n"
@@ -393,7 +517,7 @@ async def handle_error(update: object, context: CallbackContext):
                f"<b>Traceback</b>\n"
                f"<pre>{html.escape(error_text)}</pre>")
     await context.bot.send_message(
-        chat_id=MAINTAINERS_GROUP_ID, text=message, parse_mode=ParseMode.HTML
+        chat_id=MAINTAINERS_GROUP_ID, text=message, parse_mode=ParseMode.HTML, rate_limit_args=outbox.DIAGNOSTIC
     )
 
 
@@ -403,56 +527,194 @@ def main() -> None:
     parser.add_argument("function",
                         nargs='?',
                         help="The function to execute",
-                        choices=["refresh_calendar", "expire_accreds"])
+                        choices=["refresh_calendar", "expire_accreds", "audit_indexes"])
     args = parser.parse_args()
 
     if args.function == "refresh_calendar":
-        managecalendar.refresh_calendar(truffe.get_reservations())
+        refresh_calendar()
+        startup.mark("refresh_calendar")
         return
     elif args.function == "expire_accreds":
-        database.expire_accreds()
+        asyncio.run(database.expire_accreds())
+        startup.mark("expire_accreds")
+        return
+    elif args.function == "audit_indexes":
+        asyncio.run(audit_indexes())
         return
 
     print("Going live!")
-    # Create application
-    application = Application.builder().token(TOKEN).build()
+    # First, before the clients of the bot start their threads
+    pdfmerge.start()
+    application = build_application()
 
-    # Add handlers
-    application.add_handler(CommandHandler('start', start))
-    application.add_handler(CommandHandler('forget', forget))
-    application.add_handler(CommandHandler('help', help_command))
-    application.add_handler(CommandHandler('contact', contact_command))
-    application.add_handler(CommandHandler('join', join))
-    application.add_handler(CommandHandler(['reservations', 'res'], get_reservations))
-    application.add_handler(CommandHandler('pdf', get_pdf))
-    application.add_handler(CommandHandler('calendar', update_calendar))
-    application.add_handler(CommandHandler('clearcalendar', clear_calendar))
+    print("Bot starting...")
+    if ENV == 'TEST':
+        application.run_polling()
+    elif ENV == 'PROD':
+        # Serves /metrics next to the webhook, on the only port Heroku exposes
+        webserver.run(application, port=int(PORT), webhook_url=HEROKU_PATH, secret_token="tapontapon",
+                      metrics_token=get_config().metrics_token)
+    return
 
-    application.add_handler(CallbackQueryHandler(callback_query_handler))
 
-    application.add_handler(MessageHandler(filters.COMMAND, invalid_command))
-    application.add_handler(MessageHandler(filters.ALL & (~filters.StatusUpdate.ALL), handle_messages))
+def build_application(request: BaseRequest = None, rate_limited: bool = True) -> Application:
+    """Create the application with all its handlers and jobs.
+    request replaces the HTTP client used to reach Telegram, e.g. by a stub in the benchmarks."""
+    builder = Application.builder().token(TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    # A long /pdf only delays the next updates of its own chat
+    workers = get_config().update_workers or updateprocessor.MAX_CONCURRENT_UPDATES
+    builder = builder.concurrent_updates(updateprocessor.PerChatUpdateProcessor(workers))
+    if rate_limited:
+        # Every request to Telegram goes through the same scheduler, so replies to users are not stuck behind broadcasts
+        builder = builder.rate_limiter(outbox.PriorityRateLimiter(diagnostics_chat_id=MAINTAINERS_GROUP_ID))
+    else:
+        # The handlers pass rate_limit_args, which the bot refuses without a rate limiter
+        builder = builder.rate_limiter(outbox.UnlimitedRateLimiter())
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
+
+    # Before any other handler, record the updates to replay them in the load tests
+    if get_config().update_trace_path is not None:
+        tracing.start_recording(get_config().update_trace_path, SUPPORT_GROUP_ID, MAINTAINERS_GROUP_ID)
+        application.add_handler(TypeHandler(Update, tracing.record_update), group=-1)
+
+    # Add handlers, each one records its duration and errors under its name
+    application.add_handler(CommandHandler('start', metrics.instrument(start, "start")))
+    application.add_handler(CommandHandler('forget', metrics.instrument(forget, "forget")))
+    application.add_handler(CommandHandler('help', metrics.instrument(help_command, "help")))
+    application.add_handler(CommandHandler('contact', metrics.instrument(contact_command, "contact")))
+    application.add_handler(CommandHandler('join', metrics.instrument(join, "join")))
+    application.add_handler(CommandHandler(['reservations', 'res'],
+                                           metrics.instrument(get_reservations, "reservations")))
+    application.add_handler(CommandHandler('pdf', metrics.instrument(get_pdf, "pdf")))
+    application.add_handler(CommandHandler('calendar', metrics.instrument(update_calendar, "calendar")))
+    application.add_handler(CommandHandler('clearcalendar', metrics.instrument(clear_calendar, "clearcalendar")))
+    application.add_handler(CommandHandler('stats', metrics.instrument(stats_command, "stats")))
+
+    application.add_handler(CallbackQueryHandler(metrics.instrument(callback_query_handler, _callback_handler_name)))
+
+    application.add_handler(MessageHandler(filters.COMMAND, metrics.instrument(invalid_command, "invalid_command")))
+    application.add_handler(MessageHandler(filters.ALL & (~filters.StatusUpdate.ALL),
+                                           metrics.instrument(handle_messages, "message")))
+
+    # Runs after the handlers of group 0, once the first update got its response
+    application.add_handler(TypeHandler(Update, mark_first_response), group=1)
 
     application.add_error_handler(handle_error)
 
-    print("Bot starting...")
-    if ENV == 'TEST':
-        application.run_polling()
-    elif ENV == 'PROD':
-        application.run_webhook(listen="0.0.0.0",
-                                port=int(PORT),
-                                webhook_url=HEROKU_PATH,
-                                secret_token="tapontapon")
+    # Keep the Truffe snapshot warm so that no user waits for Truffe
+    application.job_queue.run_repeating(refresh_truffe_cache, interval=truffe.TRUFFE_REFRESH_INTERVAL, first=0)
+    application.job_queue.run_repeating(refresh_pdf_bundles, interval=pdfbundles.BUNDLE_REFRESH_INTERVAL, first=5)
+    return application
+
+
+async def refresh_truffe_cache(context: CallbackContext) -> None:
+    """Refresh the Truffe snapshot in the background, with the pages of the reservations menu."""
+    try:
+        mytelegram.build_reservation_pages(await truffe.refresh_snapshot())
+    except Exception as e:
+        print("Failed to refresh the Truffe cache.")
+        print(e)
+    return
+
+
+async def refresh_pdf_bundles(context: CallbackContext) -> None:
+    """Prepare the pdfs of the current and next half days, so that /pdf answers without downloading nor merging."""
+    try:
+        built = await pdfbundles.refresh()
+        if built > 0:
+            print(f"Built {built} pdf bundle(s).")
+    except Exception as e:
+        print("Failed to build the pdf bundles.")
+        print(e)
+    return
+
+
+def _callback_handler_name(update: Update) -> str:
+    """Name of a callback query in the metrics, its first argument without the ids."""
+    kind = update.callback_query.data.split('_')[0] if update.callback_query.data else ""
+    return "callback_" + ("reservation" if kind.isdigit() else kind)
+
+
+def _register_metrics(application: Application) -> None:
+    """Expose the counters kept by the other modules in the metrics."""
+    metrics.collect("cache_hits_total", lambda: pdfcache.stats()['hits'], "counter", cache="agreements")
+    metrics.collect("cache_misses_total", lambda: pdfcache.stats()['misses'], "counter", cache="agreements")
+    metrics.collect("cache_hits_total", lambda: database.user_cache_stats()['hits'], "counter", cache="users")
+    metrics.collect("cache_misses_total", lambda: database.user_cache_stats()['misses'], "counter", cache="users")
+    metrics.collect("pdf_bundles", lambda: pdfbundles.stats()['bundles'])
+    metrics.collect("pdf_bundles_bytes", lambda: pdfbundles.stats()['size'])
+    metrics.collect("truffe_snapshot_age_seconds", lambda: truffe.cache_info()['age'])
+    metrics.collect("log_queue_size", lambda: database.log_stats()['queued'])
+    metrics.collect("logs_dropped_total", lambda: database.log_stats()['dropped'], "counter")
+    processor = application.update_processor
+    if isinstance(processor, updateprocessor.PerChatUpdateProcessor):
+        metrics.collect("updates_running", lambda: processor.stats()['running'])
+        metrics.collect("updates_pending", lambda: processor.stats()['pending'])
+        metrics.collect("update_chats_pending", lambda: processor.stats()['chats'])
+        metrics.collect("update_chat_depth_max", lambda: processor.stats()['max_chat_depth'])
+    rate_limiter = application.bot.rate_limiter
+    if isinstance(rate_limiter, outbox.PriorityRateLimiter):
+        for name in outbox.PRIORITY_NAMES.values():
+            metrics.collect("outbox_queued", lambda name=name: rate_limiter.stats()['queued'][name], priority=name)
+        metrics.collect("outbox_retries_total", lambda: rate_limiter.stats()['retries'], "counter")
+    return
+
+
+async def mark_first_response(update: Update, context: CallbackContext) -> None:
+    """Record when the first update has been answered."""
+    startup.mark("first_response")
+    return
+
+
+async def post_init(application: Application) -> None:
+    """Executed once the bot is initialized, before it starts fetching updates."""
+    database.start_log_flusher()
+    metrics.start_event_loop_monitor()
+    _register_metrics(application)
+    await database.ensure_indexes()
+    await expiry.schedule(application.job_queue)
+    startup.mark("bot_ready")
+    return
+
+
+async def post_shutdown(application: Application) -> None:
+    """Release the resources held by the bot once it stopped."""
+    await database.stop_log_flusher()
+    await metrics.stop_event_loop_monitor()
+    await truffeclient.close()
+    await asyncio.to_thread(pdfmerge.shutdown)
+    tracing.stop_recording()
+    return
+
+
+async def audit_indexes() -> None:
+    """Create the missing indexes, then print the hot queries that do not use an index."""
+    await database.ensure_indexes()
+    report = await database.audit_indexes()
+    for name, uses_index, stages in report:
+        print(f"{'OK' if uses_index else 'NO INDEX'} {name}: {' <- '.join(stages)}")
+    if all(uses_index for _, uses_index, _ in report):
+        print("All hot queries use an index.")
+    return
+
+
+async def _refresh_calendar() -> None:
+    """Fetch the reservations and refresh the calendar with them."""
+    try:
+        await managecalendar.refresh_calendar(await truffe.get_reservations())
+    finally:
+        await truffeclient.close()
     return
 
 
 def refresh_calendar() -> None:
     """Refresh the calendar."""
     print("Refreshing calendar...")
-    managecalendar.refresh_calendar(truffe.get_reservations())
+    asyncio.run(_refresh_calendar())
     return
 
 
 if __name__ == '__main__':
-    database.setup()
     main()
@@ -1,35 +1,47 @@
+import asyncio
 import datetime
+import hashlib
 import json
 import os
+from typing import AsyncIterator, Callable
 
-import httplib2
-
-from googleapiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
+from googleapiclient.errors import HttpError
 
 import database
 import env
+import metrics
 import truffe
-from env import get_env_variables
+from env import get_config
 
-ENV = get_env_variables()['ENV']
-CALENDAR_ID = get_env_variables()['CALENDAR_ID']
-GSERVICE_CREDENTIALS = get_env_variables()['GSERVICE_CREDENTIALS']
+ENV = get_config().env
+CALENDAR_ID = get_config().calendar_id
 
 TIMEZONE = 'Europe/Zurich'
 EVENT_LOCATION = "Boutique de l'AGEPoly, sur l'Esplanade"
 BOOKED_TIME = 60  # minutes
+BATCH_SIZE = 50  # maximum number of operations sent to Google in one batch request
+LIST_PAGE_SIZE = 2500  # maximum number of events Google returns in one page of a list
+
+calendar_service: any = None
 
 
 def _get_calendar() -> any:
-    """Connect to the Google Calendar API using a service account."""
+    """Connect to the Google Calendar API using a service account, only once."""
+    global calendar_service
+    if calendar_service is not None:
+        return calendar_service
     # Try to connect the service account
     try:
-        credentials = ServiceAccountCredentials.from_json_keyfile_dict(GSERVICE_CREDENTIALS, ['https://www.googleapis.com/auth/calendar'])
+        # The Google client is slow to import, only pay for it when the calendar is used
+        import httplib2
+        from googleapiclient.discovery import build
+        from oauth2client.service_account import ServiceAccountCredentials
+
+        credentials = ServiceAccountCredentials.from_json_keyfile_dict(get_config().gservice_credentials, ['https://www.googleapis.com/auth/calendar'])
         http_auth = credentials.authorize(httplib2.Http())
-        calendar = build('calendar', 'v3', http=http_auth)
+        calendar_service = build('calendar', 'v3', http=http_auth)
         print("Connected to the Google Calendar API.")
-        return calendar
+        return calendar_service
     except Exception as e:
         print("Failed to connect to the Google Calendar API.")
         print(e)
@@ -57,49 +69,94 @@ def _create_event(title: str, description: str, start: str, location: str = EVEN
     return event
 
 
-def _add_events_to_calendar(events: list, calendar: any = _get_calendar()) -> bool:
+async def _execute_in_batches(calendar: any, requests: list[tuple[str, any]],
+                              advance: Callable[[int], None] = None
+                              ) -> AsyncIterator[tuple[dict[str, any], dict[str, Exception]]]:
+    """Execute (key, request) pairs by batches of BATCH_SIZE, yielding the responses and the errors of each batch by key.
+    The blocking Google calls run in a worker thread."""
+    for start in range(0, len(requests), BATCH_SIZE):
+        chunk = requests[start:start + BATCH_SIZE]
+        responses = {}
+        errors = {}
+
+        def callback(request_id: str, response: any, exception: Exception) -> None:
+            key = chunk[int(request_id)][0]
+            if exception is None:
+                responses[key] = response
+            else:
+                errors[key] = exception
+
+        batch = calendar.new_batch_http_request(callback=callback)
+        for index, (key, request) in enumerate(chunk):
+            batch.add(request, request_id=str(index))
+        try:
+            with metrics.dependency("calendar", "batch"):
+                await asyncio.to_thread(batch.execute)
+        except Exception as e:
+            # The whole batch failed, every operation of it is in error
+            errors = {key: e for key, _ in chunk}
+            responses = {}
+        if advance is not None:
+            advance(len(chunk))
+        yield responses, errors
+
+
+def _print_errors(errors: dict[str, Exception], action: str) -> None:
+    """Print the errors collected for each operation."""
+    for key, error in errors.items():
+        print(f"Failed to {action} {key}.")
+        print(error)
+    return
+
+
+async def _add_events_to_calendar(events: list, calendar: any = None) -> bool:
     """Add events to the Google Calendar."""
+    calendar = calendar if calendar is not None else await asyncio.to_thread(_get_calendar)
     if calendar is not None:
         # Add events to the calendar
-        for event in events:
-            event = calendar.events().insert(calendarId=CALENDAR_ID, body=event).execute()
-            database.add_event_id(event['id'])
-            print(f"Event created: {event.get('summary')}")
+        requests = [(str(index), calendar.events().insert(calendarId=CALENDAR_ID, body=event))
+                    for index, event in enumerate(events)]
+        errors = {}
+        async for responses, batch_errors in _execute_in_batches(calendar, requests):
+            await database.add_event_ids([{"_id": event['id']} for event in responses.values()])
+            errors |= batch_errors
+            print(f"{len(responses)} events created.")
+        _print_errors(errors, "create event")
         print("All events added to the calendar.")
         return True
     else:
         return False
 
 
-def _update_calendar_individual_res(reservations: list[dict]) -> bool:
+async def _update_calendar_individual_res(reservations: list[truffe.Reservation]) -> bool:
     """[DEPRECATED] Add events to the Google Calendar."""
     # Prêts
-    events = [_create_event("Prêt " + reservation['asking_unit_name'], reservation['agreement'],
-                            reservation['start_date'],
+    events = [_create_event("Prêt " + reservation.asking_unit_name, reservation.agreement,
+                            reservation.start_date.isoformat(),
                             ) for reservation in reservations]
     # Rendus
-    events += [_create_event("Rendu " + reservation['asking_unit_name'], reservation['agreement'],
-                             reservation['end_date'],
+    events += [_create_event("Rendu " + reservation.asking_unit_name, reservation.agreement,
+                             reservation.end_date.isoformat(),
                              ) for reservation in reservations]
     # Create the calendar once and use it for all events
-    calendar = _get_calendar()
+    calendar = await asyncio.to_thread(_get_calendar)
     # Add events to the calendar
-    return _add_events_to_calendar(events, calendar)
+    return await _add_events_to_calendar(events, calendar)
 
 
-def _remove_minutes(date: str) -> str:
+def _remove_minutes(date: datetime.datetime) -> str:
     """Remove minutes from a date."""
-    return datetime.datetime.fromisoformat(date).replace(minute=0, second=0).isoformat()
+    return date.replace(minute=0, second=0).isoformat()
 
 
-def _create_groupe(reservations: list[dict], is_start_date: bool) -> list[dict]:
-    """Create a timeslot group in the Google Calendar."""
-    events = []
+def _create_groupe(reservations: list[truffe.Reservation], is_start_date: bool) -> dict[str, dict]:
+    """Create a timeslot group in the Google Calendar, indexed by slot."""
+    events = {}
     date_type = "start_date" if is_start_date else "end_date"
     # Group reservations by date
     grouped_reservations = {}
     for reservation in reservations:
-        event_date = _remove_minutes(reservation[date_type])
+        event_date = _remove_minutes(getattr(reservation, date_type))
         if event_date not in grouped_reservations:
             grouped_reservations[event_date] = []
         grouped_reservations[event_date].append(reservation)
@@ -111,55 +168,186 @@ def _create_groupe(reservations: list[dict], is_start_date: bool) -> list[dict]:
         # Add reservations to the description
         for reservation in reservations:
             description += '\n'.join([
-                reservation['asking_unit_name'],
-                reservation['agreement'],
-                "\t" + reservation['contact_phone'],
-                "\t" + reservation['contact_telegram']
+                reservation.asking_unit_name,
+                reservation.agreement,
+                "\t" + reservation.contact_phone,
+                "\t" + reservation.contact_telegram
             ])
             description += '\n\n'
         event = _create_event(title, description, date)
-        events.append(event)
+        events[f"{date_type}_{date}"] = event
     return events
 
 
-def _update_calendar_grouped(reservations: list[dict]) -> bool:
-    """Add events to the Google Calendar."""
+def _get_grouped_events(reservations: list[truffe.Reservation]) -> dict[str, dict]:
+    """Return the grouped events of the reservations, indexed by slot."""
     # Prêts
     events = _create_groupe(reservations, True)
     # Rendus
-    events += _create_groupe(reservations, False)
-    # Create the calendar once and use it for all events
-    calendar = _get_calendar()
-    # Add events to the calendar
-    return _add_events_to_calendar(events, calendar)
+    events |= _create_groupe(reservations, False)
+    return events
+
+
+def _fingerprint(event: dict) -> str:
+    """Return a hash of the date, type and contents of an event."""
+    return hashlib.sha256(json.dumps(event, sort_keys=True).encode()).hexdigest()
+
+
+def _is_gone(error: HttpError) -> bool:
+    """Return True if the error means that the event does not exist anymore."""
+    return error.resp.status in (404, 410)
+
+
+def _progress_counter(progress: Callable[[int, int], None], total: int) -> Callable[[int], None]:
+    """Return a callback counting the operations done and reporting them with the total to progress."""
+    done = 0
+
+    def advance(count: int) -> None:
+        nonlocal done
+        done += count
+        if progress is not None:
+            progress(done, max(done, total))
 
+    if progress is not None:
+        progress(0, total)
+    return advance
 
-def clear_calendar() -> bool:
-    """Delete all events from the Google Calendar."""
-    calendar = _get_calendar()
+
+async def clear_calendar(progress: Callable[[int, int], None] = None) -> bool:
+    """Delete all events from the Google Calendar, reporting (done, total) operations to progress."""
+    calendar = await asyncio.to_thread(_get_calendar)
     if calendar is not None:
         try:
-            events_ids = database.get_event_ids()
+            events_ids = await database.get_event_ids()
         except FileNotFoundError:
             events_ids = []
         # Delete events
-        for event_id in events_ids:
-            # Attempt to delete the event
-            try:
-                calendar.events().delete(calendarId=CALENDAR_ID, eventId=event_id).execute()
-                print(f"Event {event_id} deleted.")
-            except Exception as e:
-                print(f"Failed to delete event {event_id}.")
-                print(e)
+        errors = await _delete_events(calendar, events_ids, _progress_counter(progress, len(events_ids)))
+        _print_errors(errors, "delete event")
         print("All events deleted from the calendar.")
-        database.clear_event_ids()
-        return True
+        return not errors
     else:
         return False
 
 
-def refresh_calendar(reservations: list[dict]) -> bool:
-    """Delete all events from the calendar and add the new ones."""
-    done = clear_calendar()
-    done &= _update_calendar_grouped(reservations)
-    return done
+def _plan_sync(events: dict[str, dict], stored_events: list[dict]) -> tuple[dict, dict, list]:
+    """Compare the wanted events with the stored ones and return the slots to insert, to patch and the ids to delete."""
+    stored_by_slot = {}
+    to_delete = []
+    for stored in stored_events:
+        # Events stored before the sync existed have no slot, and a slot must be shown only once
+        if stored.get("slot") is None or stored["slot"] in stored_by_slot:
+            to_delete.append(stored["_id"])
+        else:
+            stored_by_slot[stored["slot"]] = stored
+
+    to_insert = {}
+    to_patch = {}
+    for slot, event in events.items():
+        stored = stored_by_slot.pop(slot, None)
+        if stored is None:
+            to_insert[slot] = event
+        elif stored.get("fingerprint") != _fingerprint(event):
+            to_patch[stored["_id"]] = (slot, event)
+    to_delete += [stored["_id"] for stored in stored_by_slot.values()]
+    return to_insert, to_patch, to_delete
+
+
+def _list_event_ids(calendar: any) -> set[str]:
+    """Return the ids of all the events of the calendar, one request per LIST_PAGE_SIZE events."""
+    event_ids = set()
+    page_token = None
+    while True:
+        page = calendar.events().list(calendarId=CALENDAR_ID, maxResults=LIST_PAGE_SIZE, pageToken=page_token,
+                                      fields="items(id),nextPageToken").execute()
+        event_ids |= {event['id'] for event in page.get('items', [])}
+        page_token = page.get('nextPageToken')
+        if page_token is None:
+            return event_ids
+
+
+async def _forget_missing_events(calendar: any, stored_events: list[dict]) -> list[dict]:
+    """Forget the stored events that are not in the calendar anymore, e.g. deleted by hand, so that the sync inserts
+    them again. Returns the stored events still in the calendar, or all of them if the calendar cannot be listed."""
+    try:
+        with metrics.dependency("calendar", "list"):
+            event_ids = await asyncio.to_thread(_list_event_ids, calendar)
+    except Exception as e:
+        print("Failed to list the events of the calendar, the events deleted by hand are not checked.")
+        print(e)
+        return stored_events
+    missing = [stored["_id"] for stored in stored_events if stored["_id"] not in event_ids]
+    await database.remove_event_ids(missing)
+    if missing:
+        print(f"{len(missing)} events are missing from the calendar.")
+    return [stored for stored in stored_events if stored["_id"] in event_ids]
+
+
+async def _delete_events(calendar: any, event_ids: list[str],
+                         advance: Callable[[int], None] = None) -> dict[str, Exception]:
+    """Delete events from the Google Calendar and forget them, returning the errors by event id."""
+    requests = [(event_id, calendar.events().delete(calendarId=CALENDAR_ID, eventId=event_id))
+                for event_id in event_ids]
+    errors = {}
+    async for responses, batch_errors in _execute_in_batches(calendar, requests, advance):
+        # Events that were already deleted by hand are forgotten as well
+        gone = [event_id for event_id, e in batch_errors.items() if isinstance(e, HttpError) and _is_gone(e)]
+        await database.remove_event_ids(list(responses) + gone)
+        errors |= {event_id: e for event_id, e in batch_errors.items() if event_id not in gone}
+        print(f"{len(responses) + len(gone)} events deleted.")
+    return errors
+
+
+async def _patch_events(calendar: any, events: dict[str, tuple[str, dict]],
+                        advance: Callable[[int], None] = None) -> tuple[dict[str, dict], dict[str, Exception]]:
+    """Patch events by event id, returning the events that disappeared by slot and the errors by event id."""
+    requests = [(event_id, calendar.events().patch(calendarId=CALENDAR_ID, eventId=event_id, body=event))
+                for event_id, (slot, event) in events.items()]
+    errors = {}
+    gone = {}
+    async for responses, batch_errors in _execute_in_batches(calendar, requests, advance):
+        await database.update_event_fingerprints({event_id: _fingerprint(events[event_id][1]) for event_id in responses})
+        for event_id, e in batch_errors.items():
+            if isinstance(e, HttpError) and _is_gone(e):
+                # Someone removed the event by hand, it has to be created again
+                gone[events[event_id][0]] = events[event_id][1]
+            else:
+                errors[event_id] = e
+        await database.remove_event_ids([event_id for event_id in batch_errors if event_id not in errors])
+        print(f"{len(responses)} events updated.")
+    return gone, errors
+
+
+async def _insert_events(calendar: any, events: dict[str, dict],
+                         advance: Callable[[int], None] = None) -> dict[str, Exception]:
+    """Insert events by slot and remember them, returning the errors by slot."""
+    requests = [(slot, calendar.events().insert(calendarId=CALENDAR_ID, body=event)) for slot, event in events.items()]
+    errors = {}
+    async for responses, batch_errors in _execute_in_batches(calendar, requests, advance):
+        await database.add_event_ids([{"_id": response['id'], "slot": slot, "fingerprint": _fingerprint(events[slot])}
+                                      for slot, response in responses.items()])
+        errors |= batch_errors
+        print(f"{len(responses)} events created.")
+    return errors
+
+
+async def refresh_calendar(reservations: list[truffe.Reservation], progress: Callable[[int, int], None] = None) -> bool:
+    """Update the calendar so that it shows the reservations, only touching the slots that changed.
+    Reports (done, total) operations to progress."""
+    calendar = await asyncio.to_thread(_get_calendar)
+    if calendar is None:
+        return False
+    stored_events = await _forget_missing_events(calendar, await database.get_events())
+    to_insert, to_patch, to_delete = _plan_sync(_get_grouped_events(reservations), stored_events)
+    print(f"Calendar sync: {len(to_insert)} to insert, {len(to_patch)} to patch, {len(to_delete)} to delete.")
+
+    # Events removed by hand since the listing are inserted again, so the total can grow a bit during the sync
+    advance = _progress_counter(progress, len(to_delete) + len(to_patch) + len(to_insert))
+    delete_errors = await _delete_events(calendar, to_delete, advance)
+    gone, patch_errors = await _patch_events(calendar, to_patch, advance)
+    insert_errors = await _insert_events(calendar, to_insert | gone, advance)
+
+    _print_errors(delete_errors, "delete event")
+    _print_errors(patch_errors, "update event")
+    _print_errors(insert_errors, "create event for slot")
+    return not (delete_errors or patch_errors or insert_errors)
@@ -0,0 +1,223 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import threading
+import time
+from typing import Callable
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+EVENT_LOOP_LAG_INTERVAL = 1  # seconds between two measures of the event loop lag
+
+# A metric is identified by its name and its sorted labels
+Key = tuple[str, tuple[tuple[str, str], ...]]
+
+
+class Histogram:
+    """Distribution of durations, counted in fixed buckets."""
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        return
+
+    def quantile(self, q: float) -> float | None:
+        """Return the upper bound of the bucket holding the q-quantile, None if nothing was observed."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulated = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulated += count
+            if cumulated >= rank:
+                return bound
+        return BUCKETS[-1]
+
+
+histograms: dict[Key, Histogram] = {}
+counters: dict[Key, float] = {}
+# Values owned by other modules, read when the metrics are rendered: key -> (type, function returning the value)
+collected: dict[Key, tuple[str, Callable[[], float]]] = {}
+
+# The Mongo driver reports its commands from its own threads
+lock = threading.Lock()
+
+event_loop_monitor: asyncio.Task = None
+event_loop_lag = 0.0
+
+
+def _key(name: str, labels: dict[str, str]) -> Key:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _format_key(key: Key, extra: tuple[tuple[str, str], ...] = ()) -> str:
+    name, labels = key
+    labels = labels + extra
+    if not labels:
+        return name
+    escaped = [(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in labels]
+    return name + '{' + ','.join(f'{label}="{value}"' for label, value in escaped) + '}'
+
+
+def observe(name: str, seconds: float, **labels: str) -> None:
+    """Record a duration in the histogram of the given name and labels."""
+    key = _key(name, labels)
+    with lock:
+        if key not in histograms:
+            histograms[key] = Histogram()
+        histograms[key].observe(seconds)
+    return
+
+
+def inc(name: str, amount: float = 1, **labels: str) -> None:
+    """Increase the counter of the given name and labels."""
+    key = _key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+    return
+
+
+def collect(name: str, function: Callable[[], float], kind: str = "gauge", **labels: str) -> None:
+    """Expose a value computed by another module, e.g. the size of a queue or the hits of a cache."""
+    collected[_key(name, labels)] = (kind, function)
+    return
+
+
+@contextlib.contextmanager
+def timer(name: str, **labels: str):
+    """Record the duration of the block in the histogram of the given name, even if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextlib.contextmanager
+def dependency(name: str, operation: str):
+    """Record the duration and the errors of a call to an external service."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("dependency_errors_total", dependency=name, operation=operation)
+        raise
+    finally:
+        observe("dependency_seconds", time.perf_counter() - start, dependency=name, operation=operation)
+
+
+def instrument(callback: Callable, name: str | Callable[[any], str]) -> Callable:
+    """Wrap a handler to record its duration and errors, name can be computed from the update."""
+    @functools.wraps(callback)
+    async def wrapper(update: any, context: any) -> any:
+        handler = name(update) if callable(name) else name
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            inc("handler_errors_total", handler=handler)
+            raise
+        finally:
+            observe("handler_seconds", time.perf_counter() - start, handler=handler)
+    return wrapper
+
+
+async def _monitor_event_loop(interval: float) -> None:
+    """Measure how late the event loop wakes up a task, which is the time any update waits for the loop."""
+    global event_loop_lag
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        event_loop_lag = max(0.0, time.perf_counter() - start - interval)
+        observe("event_loop_lag_seconds", event_loop_lag)
+
+
+def start_event_loop_monitor(interval: float = EVENT_LOOP_LAG_INTERVAL) -> None:
+    """Start measuring the event loop lag, in the running loop."""
+    global event_loop_monitor
+    collect("event_loop_lag_last_seconds", lambda: event_loop_lag)
+    if event_loop_monitor is None or event_loop_monitor.done():
+        event_loop_monitor = asyncio.create_task(_monitor_event_loop(interval))
+    return
+
+
+async def stop_event_loop_monitor() -> None:
+    """Stop measuring the event loop lag."""
+    global event_loop_monitor
+    if event_loop_monitor is not None:
+        event_loop_monitor.cancel()
+        try:
+            await event_loop_monitor
+        except asyncio.CancelledError:
+            pass
+        event_loop_monitor = None
+    return
+
+
+def summary(name: str) -> dict[str, dict[str, any]]:
+    """Return the count, mean, p50 and p95 of the histograms of the given name, by their label values."""
+    return {
+        ' / '.join(value for _, value in key[1]): {
+            'count': histogram.count,
+            'mean': histogram.sum / histogram.count if histogram.count else None,
+            'p50': histogram.quantile(0.5),
+            'p95': histogram.quantile(0.95),
+        }
+        for key, histogram in sorted(histograms.items()) if key[0] == name
+    }
+
+
+def value(name: str, **labels: str) -> float | None:
+    """Return the current value of a counter or of a collected metric, None if it does not exist."""
+    key = _key(name, labels)
+    if key in counters:
+        return counters[key]
+    if key in collected:
+        return collected[key][1]()
+    return None
+
+
+def render() -> str:
+    """Return all the metrics in the Prometheus text format."""
+    lines = []
+    declared = set()
+
+    def declare(name: str, kind: str) -> None:
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+        return
+
+    with lock:
+        snapshot = [(key, histogram.counts.copy(), histogram.sum, histogram.count)
+                    for key, histogram in sorted(histograms.items())]
+        values = [(key, "counter", amount) for key, amount in counters.items()]
+    for key, counts, total, count in snapshot:
+        declare(key[0], "histogram")
+        cumulated = 0
+        for bound, bucket_count in zip(BUCKETS, counts):
+            cumulated += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{_format_key((key[0] + '_bucket', key[1]), (('le', le),))} {cumulated}")
+        lines.append(f"{_format_key((key[0] + '_sum', key[1]))} {total}")
+        lines.append(f"{_format_key((key[0] + '_count', key[1]))} {count}")
+    for key, (kind, function) in list(collected.items()):
+        try:
+            values.append((key, kind, function()))
+        except Exception as e:
+            print(f"Failed to collect the metric {_format_key(key)}.")
+            print(e)
+    # The lines of a metric must be contiguous, whether they come from a counter or a collected value
+    for key, kind, amount in sorted(values, key=lambda entry: entry[0]):
+        if amount is None:
+            continue
+        declare(key[0], kind)
+        lines.append(f"{_format_key(key)} {amount}")
+    return '\n'.join(lines) + '\n'
@@ -2,45 +2,91 @@ import telegram
 from telegram import Update
 from telegram.ext import CallbackContext
 
+import broadcast
 import database
+import metrics
 import truffe
 from accred import Accred
-from main import DEFAULT_CONTACT
 
 MAX_RES_PER_PAGE = 10
 
+DEFAULT_CONTACT = "logistique@agepoly.ch"
 
-def get_reservations_keyboard(states: list, page: int, displaying_all_res: bool = False) -> (
+
+# (states, displaying_all_res) -> (version of the snapshot, keyboard of each page)
+reservation_pages: dict[tuple[tuple[str, ...], bool], tuple[int, tuple[telegram.InlineKeyboardMarkup, ...]]] = {}
+
+# The views of the /reservations menu, built as soon as a snapshot arrives
+RESERVATION_VIEWS = [
+    (truffe.DEFAULT_ACCEPTED_STATES, False),
+    (truffe.EXTENDED_ACCEPTED_STATES, True),
+]
+
+
+def _build_reservation_pages(res_list: list[truffe.Reservation], short_infos: dict[int, str],
+                             displaying_all_res: bool) -> tuple[telegram.InlineKeyboardMarkup, ...]:
+    """Returns the keyboard of every page of the given reservations, there is always at least one page."""
+    disp = "all" if displaying_all_res else "def"
+    page_count = max(1, -(-len(res_list) // MAX_RES_PER_PAGE))
+    pages = []
+    for page in range(page_count):
+        keyboard = []
+        for res in res_list[page * MAX_RES_PER_PAGE: (page + 1) * MAX_RES_PER_PAGE]:
+            keyboard.append([telegram.InlineKeyboardButton(short_infos[res.pk],
+                                                           callback_data='_'.join([str(res.pk), disp, str(page)]))])
+
+        # If we are already displaying all the reservations, we add a button to go back to the default view
+        navigation_buttons = []
+        if page > 0:
+            navigation_buttons.append(
+                telegram.InlineKeyboardButton("⬅️", callback_data=f"page_{disp}_{page - 1}")
+            )
+        if displaying_all_res:
+            navigation_buttons.append(
+                telegram.InlineKeyboardButton("Voir validées", callback_data=f"page_def_{page}")
+            )
+        else:
+            navigation_buttons.append(
+                telegram.InlineKeyboardButton("Voir Toutes", callback_data=f"page_all_{page}")
+            )
+        if page < page_count - 1:
+            navigation_buttons.append(
+                telegram.InlineKeyboardButton("➡️", callback_data=f"page_{disp}_{page + 1}")
+            )
+        keyboard.append(navigation_buttons)
+        pages.append(telegram.InlineKeyboardMarkup(keyboard))
+    return tuple(pages)
+
+
+def build_reservation_pages(snapshot: truffe.Snapshot, views: list[tuple[list, bool]] = None) -> None:
+    """Build the pages of the given views of the menu for a snapshot, the short infos are formatted only once."""
+    views = RESERVATION_VIEWS if views is None else views
+    stale_views = [view for view in views
+                   if reservation_pages.get((tuple(view[0]), view[1]), (None,))[0] != snapshot.version]
+    if not stale_views:
+        return
+    short_infos = {res.pk: truffe.get_res_short_info(res) for res in snapshot.reservations}
+    for states, displaying_all_res in stale_views:
+        res_list = [res for res in snapshot.reservations if res.state in states]
+        reservation_pages[(tuple(states), displaying_all_res)] = (
+            snapshot.version, _build_reservation_pages(res_list, short_infos, displaying_all_res))
+    return
+
+
+async def get_reservations_keyboard(states: list, page: int, displaying_all_res: bool = False) -> (
         telegram.InlineKeyboardMarkup, int):
     """Returns a keyboard with the reservations of the given states, starting at the given page."""
-    res_list = truffe.get_res_pk_info(states)
-    keyboard = []
-    while len(res_list) <= page * MAX_RES_PER_PAGE:
-        page -= 1
-    disp = "all" if displaying_all_res else "def"
-    for res in res_list[page * MAX_RES_PER_PAGE: (page + 1) * MAX_RES_PER_PAGE]:
-        keyboard.append([telegram.InlineKeyboardButton(res[1], callback_data='_'.join([str(res[0]), disp, str(page)]))])
-
-    # If we are already displaying all the reservations, we add a button to go back to the default view
-    navigation_buttons = []
-    if page > 0:
-        navigation_buttons.append(
-            telegram.InlineKeyboardButton("⬅️", callback_data=f"page_{disp}_{page - 1}")
-        )
-    if displaying_all_res:
-        navigation_buttons.append(
-            telegram.InlineKeyboardButton("Voir validées", callback_data=f"page_def_{page}")
-        )
+    snapshot = await truffe.get_snapshot()
+    key = (tuple(states), displaying_all_res)
+    if reservation_pages.get(key, (None,))[0] != snapshot.version:
+        metrics.inc("cache_misses_total", cache="reservation_pages")
+        build_reservation_pages(snapshot, [(states, displaying_all_res)])
     else:
-        navigation_buttons.append(
-            telegram.InlineKeyboardButton("Voir Toutes", callback_data=f"page_all_{page}")
-        )
-    if len(res_list) > (page + 1) * MAX_RES_PER_PAGE:
-        navigation_buttons.append(
-            telegram.InlineKeyboardButton("➡️", callback_data=f"page_{disp}_{page + 1}")
-        )
-    keyboard.append(navigation_buttons)
-    return telegram.InlineKeyboardMarkup(keyboard), page
+        metrics.inc("cache_hits_total", cache="reservation_pages")
+    pages = reservation_pages[key][1]
+    # The list may have shrunk since the keyboard with this page was sent
+    page = max(0, min(page, len(pages) - 1))
+    return pages[page], page
 
 
 def get_one_res_keyboard(res_pk: int, page: int, displaying_all_res: bool) -> telegram.InlineKeyboardMarkup:
@@ -58,6 +104,15 @@ def get_one_res_keyboard(res_pk: int, page: int, displaying_all_res: bool) -> te
     return telegram.InlineKeyboardMarkup(keyboard)
 
 
+def get_back_to_reservations_keyboard(page: int, displaying_all_res: bool) -> telegram.InlineKeyboardMarkup:
+    """Returns a keyboard with a single button to go back to the list of reservations"""
+    disp = "all" if displaying_all_res else "def"
+    keyboard = [
+        [telegram.InlineKeyboardButton("⬅️", callback_data='_'.join(["reservations", disp, str(page)]))]
+    ]
+    return telegram.InlineKeyboardMarkup(keyboard)
+
+
 def get_join_keyboard(user_id: int) -> telegram.InlineKeyboardMarkup:
     """Returns a keyboard with the link to join the group"""
     keyboard = [
@@ -73,16 +128,13 @@ async def send_join_request(update: Update, context: CallbackContext, accred_req
         [telegram.InlineKeyboardButton(f"Accred {user.first_name} as {accred_req}", callback_data="_".join(["ok", str(accred_req.value), str(user.id)]))],
         [telegram.InlineKeyboardButton("Deny", callback_data="_".join(["no", str(accred_req.value), str(user.id)]))]
     ]
-    ids = database.get_users_by_accred_extended(accred_validator.value)
+    ids = await database.get_users_by_accred_extended(accred_validator.value)
     if ids:
-        for chat_id in ids:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"{user.first_name} ({user.id}) souhaite obtenir le rôle de {accred_req}!\n"
-                     f"Son username est @{user.username}.\n" if user.username else ""
-                     f"Son rôle actuel est {Accred(database.get_accred(user.id))}.\n",
-                reply_markup=telegram.InlineKeyboardMarkup(keyboard)
-            )
+        text = f"{user.first_name} ({user.id}) souhaite obtenir le rôle de {accred_req}!\n"
+        if user.username:
+            text += f"Son username est @{user.username}.\n"
+        text += f"Son rôle actuel est {Accred(await database.get_accred(user.id))}.\n"
+        await broadcast.broadcast(context.bot, ids, text, reply_markup=telegram.InlineKeyboardMarkup(keyboard))
     else:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -0,0 +1,155 @@
+import asyncio
+import itertools
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+from ratelimit import KeyedTokenBuckets, TokenBucket
+
+# Priority classes, the lowest goes first
+SUPPORT = 0  # replies to users and support relays
+NOTIFICATION = 1  # messages nobody is waiting for, e.g. join requests
+DIAGNOSTIC = 2  # error reports to the maintainers
+
+PRIORITY_NAMES = {
+    SUPPORT: "support",
+    NOTIFICATION: "notification",
+    DIAGNOSTIC: "diagnostic",
+}
+
+GLOBAL_RATE = 30  # requests per second Telegram accepts from a bot
+PER_CHAT_RATE = 1  # messages per second in a private chat
+PER_CHAT_BURST = 3  # a handler may answer with a few messages at once
+PER_GROUP_RATE = 20  # messages per minute in a group
+MAX_RETRIES = 3  # times a request is retried after a RetryAfter
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """Schedules all the requests of the bot within the limits of Telegram, serving the lowest priority class first.
+    The class of a request is given by rate_limit_args when calling the bot, else it is DIAGNOSTIC for the
+    maintainers group and SUPPORT for everything else."""
+
+    def __init__(self, diagnostics_chat_id: int = None) -> None:
+        self.diagnostics_chat_id = diagnostics_chat_id
+        self.global_bucket = TokenBucket(GLOBAL_RATE)
+        self.chat_buckets = KeyedTokenBuckets(PER_CHAT_RATE, capacity=PER_CHAT_BURST)
+        self.group_buckets = KeyedTokenBuckets(PER_GROUP_RATE, period=60)
+        self.paused_until = 0.0
+        self.waiting: asyncio.PriorityQueue = None
+        self.dispatcher: asyncio.Task = None
+        self.sequence = itertools.count()
+        self.queued = {priority: 0 for priority in PRIORITY_NAMES}
+        self.max_queued = {priority: 0 for priority in PRIORITY_NAMES}
+        self.sent = {priority: 0 for priority in PRIORITY_NAMES}
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        self._start_dispatcher()
+        return
+
+    async def shutdown(self) -> None:
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+            self.dispatcher = None
+        return
+
+    def _start_dispatcher(self) -> None:
+        if self.dispatcher is None or self.dispatcher.done():
+            self.waiting = asyncio.PriorityQueue()
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        return
+
+    async def _dispatch(self) -> None:
+        """Hand the global tokens to the waiting requests, by priority then by arrival."""
+        while True:
+            priority, sequence, turn = await self.waiting.get()
+            if turn.done():
+                # The request was cancelled while waiting
+                continue
+            while (pause := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(pause)
+            await self.global_bucket.acquire()
+            if not turn.done():
+                turn.set_result(None)
+
+    async def _wait_turn(self, priority: int) -> None:
+        """Wait until the dispatcher lets the request through."""
+        self._start_dispatcher()
+        turn = asyncio.get_running_loop().create_future()
+        self.waiting.put_nowait((priority, next(self.sequence), turn))
+        self.queued[priority] += 1
+        self.max_queued[priority] = max(self.max_queued[priority], self.queued[priority])
+        try:
+            await turn
+        finally:
+            self.queued[priority] -= 1
+        return
+
+    def _priority(self, data: dict[str, any], rate_limit_args: int | None) -> int:
+        if rate_limit_args is not None:
+            return rate_limit_args
+        if self.diagnostics_chat_id is not None and data.get("chat_id") == self.diagnostics_chat_id:
+            return DIAGNOSTIC
+        return SUPPORT
+
+    async def _wait_chat(self, chat_id: any) -> None:
+        """Respect the limit of the chat the request is sent to."""
+        if isinstance(chat_id, int) and chat_id < 0:
+            await self.group_buckets.acquire(chat_id)
+        else:
+            await self.chat_buckets.acquire(chat_id)
+        return
+
+    async def process_request(self, callback: any, args: any, kwargs: dict[str, any], endpoint: str,
+                              data: dict[str, any], rate_limit_args: int | None) -> any:
+        priority = self._priority(data, rate_limit_args)
+        chat_id = data.get("chat_id")
+        for attempt in itertools.count():
+            if chat_id is not None:
+                await self._wait_chat(chat_id)
+            await self._wait_turn(priority)
+            try:
+                with metrics.dependency("telegram", endpoint):
+                    result = await callback(*args, **kwargs)
+                self.sent[priority] += 1
+                return result
+            except RetryAfter as e:
+                # Telegram asks the whole bot to slow down, hold every request
+                self.retries += 1
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") \
+                    else e.retry_after
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                if attempt >= MAX_RETRIES:
+                    raise
+                print(f"Telegram asked to retry {endpoint} after {retry_after} s.")
+
+    def stats(self) -> dict[str, any]:
+        """Return the queue depths and counters of the scheduler."""
+        return {
+            'queued': {PRIORITY_NAMES[priority]: count for priority, count in self.queued.items()},
+            'max_queued': {PRIORITY_NAMES[priority]: count for priority, count in self.max_queued.items()},
+            'sent': {PRIORITY_NAMES[priority]: count for priority, count in self.sent.items()},
+            'retries': self.retries,
+            'paused_for': max(0.0, self.paused_until - time.monotonic()),
+        }
+
+
+class UnlimitedRateLimiter(BaseRateLimiter[int]):
+    """Accepts the rate_limit_args of the bot without delaying anything, e.g. in the benchmarks."""
+
+    async def initialize(self) -> None:
+        return
+
+    async def shutdown(self) -> None:
+        return
+
+    async def process_request(self, callback: any, args: any, kwargs: dict[str, any], endpoint: str,
+                              data: dict[str, any], rate_limit_args: int | None) -> any:
+        with metrics.dependency("telegram", endpoint):
+            return await callback(*args, **kwargs)
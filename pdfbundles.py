@@ -0,0 +1,83 @@
+import asyncio
+import dataclasses
+import datetime
+import hashlib
+
+import metrics
+import truffe
+
+BUNDLE_REFRESH_INTERVAL = 60  # seconds between two checks of the bundles, a check without change costs no download
+STATE_VIEWS = (truffe.DEFAULT_ACCEPTED_STATES, truffe.EXTENDED_ACCEPTED_STATES)
+
+
+@dataclasses.dataclass
+class Bundle:
+    """The merged agreements of the reservations of a half day, for one selection of states."""
+    fingerprint: str
+    pks: tuple[int, ...]
+    content: bytes
+    file_id: str = None  # set once sent, Telegram then serves the same file without uploading it again
+
+
+# (date, morning, states) -> bundle of the current or next half day
+bundles: dict[tuple[datetime.date, bool, tuple[str, ...]], Bundle] = {}
+building = asyncio.Lock()
+
+
+def fingerprint(res_list: list[truffe.Reservation]) -> str:
+    """Return a short hash of the reservations of a bundle, which changes when one is added, removed or edited."""
+    serialized = ','.join(f"{res.pk}:{res.fingerprint}" for res in res_list).encode()
+    return hashlib.sha256(serialized).hexdigest()[:16]
+
+
+def _key(date: datetime.date, morning: bool, states: list) -> tuple[datetime.date, bool, tuple[str, ...]]:
+    return date, morning, tuple(states)
+
+
+def get(date: datetime.date, morning: bool, states: list, res_list: list[truffe.Reservation]) -> Bundle | None:
+    """Return the bundle of the half day, or None if it is not built for these reservations."""
+    bundle = bundles.get(_key(date, morning, states))
+    if bundle is None or bundle.fingerprint != fingerprint(res_list):
+        metrics.inc("cache_misses_total", cache="pdf_bundles")
+        return None
+    metrics.inc("cache_hits_total", cache="pdf_bundles")
+    return bundle
+
+
+async def refresh() -> int:
+    """Build the bundles of the current and next half days whose reservations changed, drop the past ones.
+    Returns the number of bundles built."""
+    async with building:
+        current = truffe.get_half_day()
+        wanted = set()
+        built = 0
+        for date, morning in (current, truffe.get_next_half_day(*current)):
+            for states in STATE_VIEWS:
+                key = _key(date, morning, states)
+                wanted.add(key)
+                res_list = await truffe.get_reservations_half_day(states, date, morning)
+                if not res_list:
+                    bundles.pop(key, None)
+                    continue
+                res_fingerprint = fingerprint(res_list)
+                # Both selections of states often hold the same reservations, they then share one bundle
+                ready = {bundle.fingerprint: bundle for bundle in bundles.values()}
+                if res_fingerprint in ready:
+                    bundles[key] = ready[res_fingerprint]
+                    continue
+                pks = tuple(res.pk for res in res_list)
+                with metrics.timer("pdf_bundle_seconds"):
+                    merged = await truffe.get_agreements_pdf_merged_from_pks(list(pks))
+                bundles[key] = Bundle(fingerprint=res_fingerprint, pks=pks, content=merged.getvalue())
+                built += 1
+        for key in [key for key in bundles if key not in wanted]:
+            del bundles[key]
+    return built
+
+
+def stats() -> dict[str, int]:
+    """Return the bundles ready and their total size."""
+    return {
+        'bundles': len(bundles),
+        'size': sum(len(bundle.content) for bundle in {id(bundle): bundle for bundle in bundles.values()}.values()),
+    }
@@ -0,0 +1,120 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+
+CACHE_DIR = os.environ.get('AGREEMENT_CACHE_DIR', os.path.join('cache', 'agreements'))
+MAX_CACHE_SIZE = 200 * 1024 * 1024  # bytes
+
+hits = 0
+misses = 0
+evictions = 0
+
+# key -> size in bytes, ordered from least to most recently used
+_entries: collections.OrderedDict = None
+_total_size = 0
+# The cache is used from worker threads, to keep the disk off the event loop: the lock guards the entries and counters
+lock = threading.Lock()
+
+
+def fingerprint(record: dict) -> str:
+    """Return a short hash of a reservation record, which changes whenever the reservation is edited."""
+    serialized = json.dumps(record, sort_keys=True, default=str).encode()
+    return hashlib.sha256(serialized).hexdigest()[:16]
+
+
+def _key(pk: int, record_fingerprint: str) -> str:
+    return f"{pk}-{record_fingerprint}"
+
+
+def _path(key: str) -> str:
+    return os.path.join(CACHE_DIR, f"{key}.pdf")
+
+
+def _load_entries() -> collections.OrderedDict:
+    """Scan the cache directory once, ordering the entries by last access."""
+    global _entries
+    global _total_size
+    if _entries is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        files = [entry for entry in os.scandir(CACHE_DIR) if entry.is_file() and entry.name.endswith('.pdf')]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        _entries = collections.OrderedDict((entry.name[:-len('.pdf')], entry.stat().st_size) for entry in files)
+        _total_size = sum(_entries.values())
+    return _entries
+
+
+def _remove(key: str) -> None:
+    global _total_size
+    _total_size -= _load_entries().pop(key)
+    try:
+        os.remove(_path(key))
+    except FileNotFoundError:
+        pass
+    return
+
+
+def get(pk: int, record_fingerprint: str) -> bytes | None:
+    """Return the cached agreement of a reservation, or None if it is not cached for this version of the record.
+    Blocking, call it from a worker thread."""
+    global hits
+    global misses
+    key = _key(pk, record_fingerprint)
+    with lock:
+        if key not in _load_entries():
+            misses += 1
+            return None
+    try:
+        with open(_path(key), 'rb') as f:
+            content = f.read()
+        os.utime(_path(key))
+    except FileNotFoundError:
+        with lock:
+            if key in _load_entries():
+                _remove(key)
+            misses += 1
+        return None
+    with lock:
+        if key in _load_entries():
+            _entries.move_to_end(key)
+        hits += 1
+    return content
+
+
+def put(pk: int, record_fingerprint: str, content: bytes) -> None:
+    """Store the agreement of a reservation, dropping its outdated versions and the least recently used entries.
+    Blocking, call it from a worker thread."""
+    global evictions
+    global _total_size
+    key = _key(pk, record_fingerprint)
+    # Write to a temporary file first so that a crash never leaves a truncated pdf behind
+    tmp_path = f"{_path(key)}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    with lock:
+        entries = _load_entries()
+        for outdated in [k for k in entries if k.startswith(f"{pk}-") and k != key]:
+            _remove(outdated)
+        if key in entries:
+            _remove(key)
+        os.replace(tmp_path, _path(key))
+        entries[key] = len(content)
+        _total_size += len(content)
+
+        while _total_size > MAX_CACHE_SIZE and len(entries) > 1:
+            _remove(next(iter(entries)))
+            evictions += 1
+    return
+
+
+def stats() -> dict[str, int]:
+    """Return the counters of the cache, without touching the disk."""
+    with lock:
+        return {
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+            'entries': len(_entries) if _entries is not None else 0,
+            'size': _total_size,
+        }
@@ -0,0 +1,71 @@
+import asyncio
+import concurrent.futures
+import io
+import multiprocessing
+import os
+
+import pypdf
+
+from env import get_config
+
+# The CPU count of the host, not of the dyno: set PDF_WORKERS to the cores the bot really has
+MAX_WORKERS = get_config().pdf_workers or 2  # processes merging pdfs, each one uses a core
+MAX_CONCURRENT_MERGES = MAX_WORKERS  # merges running or queued in the pool, the others wait in the bot
+
+pool: concurrent.futures.ProcessPoolExecutor = None
+# Forked at startup: a spawned worker would import the whole bot again through __main__, a forked one imports
+# nothing and shares the memory of the bot until it writes to it. Once the bot runs threads, forking could copy a
+# lock they hold, so the pools rebuilt after a crash are spawned.
+start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+merge_slots = asyncio.Semaphore(MAX_CONCURRENT_MERGES)
+
+
+def merge(agreements: list[bytes]) -> bytes:
+    """Merge the agreements in one pdf, each one starting on an odd page so that they can be printed double-sided.
+    Runs in a worker process: only bytes go in and out."""
+    writer = pypdf.PdfWriter()
+    for agreement in agreements:
+        writer.append(pypdf.PdfReader(io.BytesIO(agreement)))
+        if len(writer.pages) % 2 == 1:
+            writer.add_blank_page()
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Return the pool of the bot, creating it on first use."""
+    global pool
+    if pool is None:
+        pool = concurrent.futures.ProcessPoolExecutor(MAX_WORKERS, mp_context=multiprocessing.get_context(start_method))
+    return pool
+
+
+def start() -> None:
+    """Create the pool and start its workers. Call it before the bot starts any thread (Mongo, Google, asyncio
+    executors): they would be forked in the middle of what they are doing."""
+    # With fork, the first task starts all the workers at once
+    _get_pool().submit(os.getpid).result()
+    return
+
+
+async def merge_in_pool(agreements: list[bytes]) -> bytes:
+    """Merge the agreements in a worker process, without blocking the event loop."""
+    global pool, start_method
+    async with merge_slots:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(_get_pool(), merge, agreements)
+        except concurrent.futures.BrokenExecutor:
+            # A worker died, the pool refuses any other task: the next merge spawns a new one
+            pool = None
+            start_method = "spawn"
+            raise
+
+
+def shutdown() -> None:
+    """Stop the worker processes, dropping the merges that did not start."""
+    global pool
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+        pool = None
+    return
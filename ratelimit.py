@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Lets through `rate` operations per `period` seconds on average, with bursts of up to `capacity` operations."""
+
+    def __init__(self, rate: float, period: float = 1, capacity: float = None) -> None:
+        self.rate = rate / period
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return
+
+    def delay(self) -> float:
+        """Return the number of seconds before an operation can go through."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def is_full(self) -> bool:
+        """Return True if the bucket has not been used recently."""
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self) -> None:
+        """Wait until an operation can go through and account for it."""
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.tokens -= 1
+        return
+
+
+class KeyedTokenBuckets:
+    """One token bucket per key (e.g. per chat), created on first use."""
+
+    def __init__(self, rate: float, period: float = 1, capacity: float = None, max_idle_buckets: int = 1000) -> None:
+        self.rate = rate
+        self.period = period
+        self.capacity = capacity
+        self.max_idle_buckets = max_idle_buckets
+        self.buckets: dict[any, TokenBucket] = {}
+
+    def get(self, key: any) -> TokenBucket:
+        """Return the bucket of a key."""
+        if key not in self.buckets:
+            if len(self.buckets) >= self.max_idle_buckets:
+                # Buckets that are full behave exactly like new ones, they can be dropped
+                self.buckets = {k: bucket for k, bucket in self.buckets.items() if not bucket.is_full()}
+            self.buckets[key] = TokenBucket(self.rate, self.period, self.capacity)
+        return self.buckets[key]
+
+    async def acquire(self, key: any) -> None:
+        """Wait until an operation can go through for a key and account for it."""
+        await self.get(key).acquire()
+        return
@@ -0,0 +1,19 @@
+import time
+
+# Imported first by main, so the marks include the import time of every other module
+STARTED_AT = time.perf_counter()
+
+marks: dict[str, float] = {}
+
+
+def mark(name: str) -> float:
+    """Record the time elapsed since the start of the process the first time a step is reached."""
+    if name not in marks:
+        marks[name] = time.perf_counter() - STARTED_AT
+        print(f"Startup: {name} after {marks[name]:.3f} s")
+    return marks[name]
+
+
+def report() -> str:
+    """Return the time at which each step of the startup was reached."""
+    return '\n'.join(f"{name} : {elapsed:.3f} s" for name, elapsed in marks.items())
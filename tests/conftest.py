@@ -0,0 +1,14 @@
+import os
+
+# The modules of the bot read their configuration when imported: point them to nothing real before the tests import
+# them, even if a .env file is present
+os.environ.update({
+    'ENV': 'TEST',
+    'TOKEN': '123456:test',
+    'TRUFFE_TOKEN': 'test',
+    'CALENDAR_ID': 'test',
+    'GSERVICE_CREDENTIALS': '{}',
+    'MONGO_URI': 'mongodb://127.0.0.1:1',
+    'SUPPORT_GROUP_ID': '-1001',
+    'MAINTAINERS_GROUP_ID': '-1002',
+})
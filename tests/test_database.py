@@ -0,0 +1,20 @@
+import asyncio
+
+from benchmarks import environment  # first, it configures the bot before the bot is imported
+from mongomock_motor import AsyncMongoMockClient
+
+import database
+
+
+def test_ensure_indexes_builds_the_others_when_one_fails() -> None:
+    async def scenario() -> set[str]:
+        database.setup(AsyncMongoMockClient())
+        users = database._get_db()[database.USERS_COLLECTION_NAME]
+        # Duplicated telegram ids prevent the unique index
+        await users.insert_many([{"telegram_id": 1}, {"telegram_id": 1}])
+        await database.ensure_indexes()
+        return set(await users.index_information())
+
+    indexes = asyncio.run(scenario())
+    assert "telegram_id_unique" not in indexes
+    assert {"accred", "expires", "units_expires"} <= indexes
@@ -0,0 +1,29 @@
+import asyncio
+
+from benchmarks import environment  # first, it configures the bot before the bot is imported
+import pymongo.errors
+import pytest
+
+import database
+import expiry
+
+
+class FakeJobQueue:
+    def __init__(self) -> None:
+        self.scheduled = []
+
+    def get_jobs_by_name(self, name: str) -> list:
+        return []
+
+    def run_once(self, callback: any, when: float, name: str = None) -> None:
+        self.scheduled.append((callback, when, name))
+
+
+def test_schedule_retries_later_when_mongo_fails(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def unreachable() -> None:
+        raise pymongo.errors.ServerSelectionTimeoutError("no server")
+
+    monkeypatch.setattr(database, 'get_next_expiry', unreachable)
+    job_queue = FakeJobQueue()
+    asyncio.run(expiry.schedule(job_queue))
+    assert job_queue.scheduled == [(expiry.expire_job, expiry.RETRY_DELAY, expiry.JOB_NAME)]
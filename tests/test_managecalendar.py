@@ -0,0 +1,120 @@
+import asyncio
+import math
+
+from benchmarks import environment  # first, it configures the bot before the bot is imported
+import pytest
+from googleapiclient.errors import HttpError
+from mongomock_motor import AsyncMongoMockClient
+
+import database
+import managecalendar
+from benchmarks import fakes
+
+WRITES = ['add_event_ids', 'update_event_fingerprints', 'remove_event_ids']
+
+
+@pytest.fixture
+def calendar() -> fakes.FakeCalendar:
+    database.setup(AsyncMongoMockClient())
+    return fakes.FakeCalendar()
+
+
+@pytest.fixture
+def writes(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    """The Mongo writes of the calendar, by name of the database function. Calls with nothing to write are free."""
+    calls = []
+    for name in WRITES:
+        def counted(operations: any, name: str = name, write: any = getattr(database, name)) -> any:
+            if operations:
+                calls.append(name)
+            return write(operations)
+        monkeypatch.setattr(database, name, counted)
+    return calls
+
+
+def _events(count: int) -> dict[str, dict]:
+    return {f"slot_{index}": managecalendar._create_event(f"Event {index}", "", f"2024-01-01T{index % 24:02}:00:00")
+            for index in range(count)}
+
+
+async def _insert(calendar: fakes.FakeCalendar, count: int) -> list[str]:
+    """Insert events in the calendar and the database, returning their ids."""
+    errors = await managecalendar._insert_events(calendar, _events(count))
+    assert errors == {}
+    return list(calendar.events_by_id)
+
+
+@pytest.mark.parametrize('count', [1, 50, 51, 120])
+def test_insert_one_round_trip_and_one_write_per_batch(calendar: fakes.FakeCalendar, writes: list[str],
+                                                        count: int) -> None:
+    asyncio.run(_insert(calendar, count))
+    assert calendar.round_trips == math.ceil(count / managecalendar.BATCH_SIZE)
+    assert writes == ['add_event_ids'] * calendar.round_trips
+    assert len(asyncio.run(database.get_event_ids())) == count
+
+
+def test_delete_collects_errors_and_forgets_gone_events(calendar: fakes.FakeCalendar, writes: list[str]) -> None:
+    event_ids = asyncio.run(_insert(calendar, 120))
+    calendar.round_trips = 0
+    writes.clear()
+    del calendar.events_by_id[event_ids[0]]  # deleted by hand
+    calendar.errors[event_ids[1]] = 500
+
+    errors = asyncio.run(managecalendar._delete_events(calendar, event_ids))
+
+    assert calendar.round_trips == 3
+    assert writes == ['remove_event_ids'] * 3
+    assert list(errors) == [event_ids[1]]
+    assert isinstance(errors[event_ids[1]], HttpError)
+    assert asyncio.run(database.get_event_ids()) == [event_ids[1]]
+
+
+def test_patch_returns_gone_events_and_collects_errors(calendar: fakes.FakeCalendar, writes: list[str]) -> None:
+    event_ids = asyncio.run(_insert(calendar, 60))
+    calendar.round_trips = 0
+    writes.clear()
+    del calendar.events_by_id[event_ids[0]]  # deleted by hand
+    calendar.errors[event_ids[1]] = 500
+    changed = {event_id: (f"slot_{index}", {'summary': f"Changed {index}"}) for index, event_id in enumerate(event_ids)}
+
+    gone, errors = asyncio.run(managecalendar._patch_events(calendar, changed))
+
+    assert calendar.round_trips == 2
+    assert gone == {"slot_0": {'summary': "Changed 0"}}
+    assert list(errors) == [event_ids[1]]
+    # The gone event is forgotten in the same batch as the fingerprints are updated
+    assert writes == ['update_event_fingerprints', 'remove_event_ids', 'update_event_fingerprints']
+    assert event_ids[0] not in asyncio.run(database.get_event_ids())
+
+
+def test_refresh_recreates_changed_events_deleted_by_hand(calendar: fakes.FakeCalendar,
+                                                          monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(managecalendar, 'calendar_service', calendar)
+    event_ids = asyncio.run(_insert(calendar, 10))
+    del calendar.events_by_id[event_ids[0]]  # deleted by hand
+    events = _events(10)
+    events["slot_0"]['description'] = "Changed"
+    monkeypatch.setattr(managecalendar, '_get_grouped_events', lambda reservations: events)
+
+    assert asyncio.run(managecalendar.refresh_calendar([]))
+    assert len(calendar.events_by_id) == 10
+    assert [event['description'] for event in calendar.events_by_id.values()].count("Changed") == 1
+    assert event_ids[0] not in asyncio.run(database.get_event_ids())
+
+
+def test_refresh_recreates_unchanged_events_deleted_by_hand(calendar: fakes.FakeCalendar,
+                                                            monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(managecalendar, 'calendar_service', calendar)
+    monkeypatch.setattr(managecalendar, '_get_grouped_events', lambda reservations: _events(10))
+    assert asyncio.run(managecalendar.refresh_calendar([]))
+    event_ids = list(calendar.events_by_id)
+    del calendar.events_by_id[event_ids[0]]  # deleted by hand
+    calendar.round_trips = 0
+
+    assert asyncio.run(managecalendar.refresh_calendar([]))
+    assert len(calendar.events_by_id) == 10
+    # The listing, then the batch inserting the missing event
+    assert calendar.round_trips == 2
+    stored = asyncio.run(database.get_event_ids())
+    assert event_ids[0] not in stored
+    assert sorted(stored) == sorted(calendar.events_by_id)
@@ -0,0 +1,37 @@
+import asyncio
+import concurrent.futures
+import io
+import os
+import signal
+
+from benchmarks import environment  # first, it configures the bot before the bot is imported
+import pypdf
+import pytest
+
+import pdfmerge
+
+
+def _blank_pdf() -> bytes:
+    writer = pypdf.PdfWriter()
+    writer.add_blank_page(100, 100)
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def test_pool_is_spawned_again_after_a_crash(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(pdfmerge, 'start_method', pdfmerge.start_method)  # restored after the test
+
+    async def crash_then_merge() -> bytes:
+        pdfmerge.start()
+        os.kill(next(iter(pdfmerge.pool._processes)), signal.SIGKILL)
+        with pytest.raises(concurrent.futures.BrokenExecutor):
+            await pdfmerge.merge_in_pool([_blank_pdf()])
+        return await pdfmerge.merge_in_pool([_blank_pdf()])
+
+    try:
+        merged = asyncio.run(crash_then_merge())
+        assert pdfmerge.pool._mp_context.get_start_method() == "spawn"
+        assert len(pypdf.PdfReader(io.BytesIO(merged)).pages) == 2
+    finally:
+        pdfmerge.shutdown()
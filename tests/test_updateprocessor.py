@@ -0,0 +1,66 @@
+import asyncio
+
+from telegram import Bot
+
+from benchmarks import updates
+from updateprocessor import PerChatUpdateProcessor
+
+BOT = Bot("123456:test")
+
+
+def _update(user_id: int) -> object:
+    return updates.parse(updates.command(user_id, "/help"), BOT)
+
+
+async def _run(processor: PerChatUpdateProcessor, update: object, coroutine: any) -> None:
+    await processor.process_update(update, coroutine)
+
+
+def test_updates_of_a_chat_run_in_order_and_chats_in_parallel() -> None:
+    async def scenario() -> list[str]:
+        processor = PerChatUpdateProcessor(workers=4)
+        order = []
+
+        async def handle(name: str, delay: float) -> None:
+            await asyncio.sleep(delay)
+            order.append(name)
+
+        await asyncio.gather(
+            _run(processor, _update(1), handle("1a", 0.03)),
+            _run(processor, _update(1), handle("1b", 0.0)),
+            _run(processor, _update(2), handle("2a", 0.01)),
+        )
+        assert processor.stats()['pending'] == 0
+        return order
+
+    assert asyncio.run(scenario()) == ["2a", "1a", "1b"]
+
+
+def test_cancelling_an_update_queued_behind_another_one() -> None:
+    async def scenario() -> None:
+        processor = PerChatUpdateProcessor(workers=4)
+        release = asyncio.Event()
+        ran = []
+
+        async def handle(name: str) -> None:
+            await release.wait()
+            ran.append(name)
+
+        first = asyncio.create_task(_run(processor, _update(1), handle("first")))
+        second = asyncio.create_task(_run(processor, _update(1), handle("second")))
+        await asyncio.sleep(0.01)
+        assert processor.stats()['max_chat_depth'] == 2
+
+        second.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        await first  # must neither be cancelled nor fail
+        assert second.cancelled()
+        assert ran == ["first"]
+        assert processor.stats() == {'workers': 4, 'running': 0, 'pending': 0, 'chats': 0, 'max_chat_depth': 0}
+
+        third = asyncio.create_task(_run(processor, _update(1), handle("third")))
+        await third
+        assert ran == ["first", "third"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,144 @@
+import hashlib
+import hmac
+import json
+import os
+import re
+import time
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+import weekdays
+
+# Chat ids written in place of the support and maintainers groups, replaced by the groups of the replay
+SUPPORT_CHAT = -1
+MAINTAINERS_CHAT = -2
+
+# Messages about the chat itself (members joining, title changed...), they are neither texts nor content to relay
+SERVICE_KEYS = {'new_chat_members', 'left_chat_member', 'new_chat_title', 'new_chat_photo', 'delete_chat_photo',
+                'group_chat_created', 'supergroup_chat_created', 'pinned_message', 'migrate_to_chat_id',
+                'migrate_from_chat_id'}
+# Arguments of /pdf, see main.get_pdf, and the weekdays of weekdays.Weekday.of: the only words kept after a command
+ARGUMENT_WORDS = {'a', 'all', '0', 'am', 'matin', 'morning', '1', 'pm', 'après-midi', 'afternoon', 'o', 'old'}
+# Ids of people and chats, as opposed to the ids of messages and updates
+LONG_NUMBER = re.compile(r'-?\d{7,}')
+
+# Pseudonyms only need to be stable during one recording, a new key is drawn at every start
+PSEUDONYM_KEY = os.urandom(16)
+
+trace_file = None
+trace_start: float = None
+group_ids: dict[int, int] = {}
+
+
+def _pseudonym(chat_id: int) -> int:
+    """Replace the id of a person or a chat by a stable number of the same sign."""
+    if chat_id in group_ids:
+        return group_ids[chat_id]
+    digest = hmac.new(PSEUDONYM_KEY, str(chat_id).encode(), hashlib.sha256).digest()
+    pseudonym = int.from_bytes(digest[:4], 'big') % 900_000_000 + 100_000_000
+    return -pseudonym if chat_id < 0 else pseudonym
+
+
+def _sanitize_word(word: str) -> str:
+    if word in ARGUMENT_WORDS or weekdays.Weekday.of(word) is not None:
+        return word
+    return 'x' * len(word)
+
+
+def _sanitize_text(text: str) -> str:
+    """Keep the command and the arguments the handlers understand, which select the handler and its work, and replace
+    everything else people wrote, keeping its length."""
+    if not text.startswith('/'):
+        return 'x' * len(text)
+    command, *words = text.split(' ')
+    return ' '.join([command] + [_sanitize_word(word) for word in words])
+
+
+def _user(data: dict) -> dict:
+    return {'id': _pseudonym(data['id']), 'is_bot': data.get('is_bot', False), 'first_name': "Anonyme"}
+
+
+def _chat(data: dict) -> dict:
+    return {'id': _pseudonym(data['id']), 'type': data['type']}
+
+
+def _message(data: dict) -> dict:
+    """Rebuild a message from the fields the handlers use: who sent it where, its text or the fact that it carries
+    something else (a photo, a location...), the commands in it and the message it replies to."""
+    message = {'message_id': data['message_id'], 'date': data['date'], 'chat': _chat(data['chat'])}
+    if 'from' in data:
+        message['from'] = _user(data['from'])
+    if 'text' in data:
+        message['text'] = _sanitize_text(data['text'])
+        # The command is kept as is, so are the offsets of the commands
+        commands = [entity for entity in data.get('entities', []) if entity['type'] == 'bot_command']
+        if commands:
+            message['entities'] = [{'type': 'bot_command', 'offset': entity['offset'], 'length': entity['length']}
+                                   for entity in commands]
+    elif not any(key in data for key in SERVICE_KEYS):
+        # Whatever else it carries, the support relays it with one copy: a placeholder document has the same cost
+        message['document'] = {'file_id': "file", 'file_unique_id': "file"}
+        if 'caption' in data:
+            message['caption'] = 'x' * len(data['caption'])
+    if 'reply_to_message' in data:
+        message['reply_to_message'] = _message(data['reply_to_message'])
+    return message
+
+
+def _callback_query(data: dict) -> dict:
+    query = {'id': data['id'], 'from': _user(data['from']), 'chat_instance': "chat"}
+    if 'data' in data:
+        # The callback data holds the ids of the users a request is about
+        query['data'] = LONG_NUMBER.sub(lambda match: str(_pseudonym(int(match.group()))), data['data'])
+    if 'message' in data and 'chat' in data['message']:
+        query['message'] = _message(data['message'])
+    return query
+
+
+def sanitize(data: dict) -> dict:
+    """Rebuild an update from the fields the handlers and the load generator use, leaving out everything else:
+    names, texts, locations, contacts, polls... Updates of other kinds keep only their id."""
+    update = {'update_id': data['update_id']}
+    for kind in ('message', 'edited_message'):
+        if kind in data:
+            update[kind] = _message(data[kind])
+    if 'callback_query' in data:
+        update['callback_query'] = _callback_query(data['callback_query'])
+    return update
+
+
+def start_recording(path: str, support_group_id: int = None, maintainers_group_id: int = None) -> None:
+    """Append the sanitized updates to a JSONL file, one {"t": seconds since the start, "update": ...} per line."""
+    global trace_file
+    global trace_start
+    trace_file = open(path, 'a', buffering=1)
+    trace_start = time.monotonic()
+    if support_group_id is not None:
+        group_ids[support_group_id] = SUPPORT_CHAT
+    if maintainers_group_id is not None:
+        group_ids[maintainers_group_id] = MAINTAINERS_CHAT
+    print(f"Recording the updates to {path}.")
+    return
+
+
+async def record_update(update: Update, context: CallbackContext) -> None:
+    """Handler writing every update to the trace, before any other handler."""
+    if trace_file is None:
+        return
+    try:
+        line = {'t': round(time.monotonic() - trace_start, 3), 'update': sanitize(update.to_dict())}
+        trace_file.write(json.dumps(line, ensure_ascii=False) + '\n')
+    except Exception as e:
+        # The trace must never prevent the bot from answering
+        print("Failed to record an update.")
+        print(e)
+    return
+
+
+def stop_recording() -> None:
+    global trace_file
+    if trace_file is not None:
+        trace_file.close()
+        trace_file = None
+    return
@@ -1,24 +1,31 @@
+import asyncio
+import dataclasses
 import enum
 import io
 import time
-import copy
+import types
 
 import pytz
-import requests
 import telegram
 import datetime
-import pypdf
 
-from env import get_env_variables
+import metrics
+import pdfcache
+import pdfmerge
+import truffeclient
+from truffeclient import TRUFFE_PATH
 
-TRUFFE_TOKEN = get_env_variables()['TRUFFE_TOKEN']
-TRUFFE_PATH = "https://truffe2.agepoly.ch/logistics/"
+TIMEZONE = pytz.timezone('Europe/Zurich')
 TRUFFE_CACHE_STALE = 60  # seconds
+TRUFFE_REFRESH_INTERVAL = 45  # seconds between two background refreshes, below the staleness to keep it warm
+MAX_CONCURRENT_DOWNLOADS = 8  # agreements downloaded in parallel when building a bundle
 
 MARKDOWN_VERSION = 2
 
-last_update = None
-truffe_cache = {}
+snapshot = None
+refresh_task: asyncio.Task = None
+last_refresh_duration = None
+last_refresh_error = None
 
 
 # Enum of states as str
@@ -59,151 +66,221 @@ STATE_MAPPING = {
 }
 
 
-def _remove_external_difference(res_list: list[dict]) -> list[dict]:
-    """Remove the difference between a reservation of an external unit and a reservation of an internal unit"""
-    # fill the asking_unit_name field with the concatenation of the asking_external_unit and the asking_external_person
-    for res in res_list:
-        if res['asking_unit_name'] is None:
-            res['asking_unit_name'] = res['asking_external_unit'] + ' (' + res['asking_external_person'] + ')'
-    return res_list
-
-
 def _datetime(date: str) -> datetime.datetime:
-    return datetime.datetime.fromisoformat(date).astimezone(pytz.timezone('Europe/Zurich'))
-
-
-def _shift_time(date: str) -> str:
-    """Shift a date to the current time zone"""
-    return _datetime(date).isoformat()
+    return datetime.datetime.fromisoformat(date).astimezone(TIMEZONE)
 
 
-def _manage_time_shift(res_list: list[dict[str, str]]) -> list[dict]:
-    """Shift the dates of the reservations to the current time zone"""
-    for res in res_list:
-        res['start_date'] = _shift_time(res['start_date'])
-        res['end_date'] = _shift_time(res['end_date'])
-    return res_list
-
-
-def _sort_by_date(res_list: list[dict]) -> list[dict]:
-    """Sort a list of reservations by date"""
-    return sorted(res_list, key=lambda res: res['start_date'])
+def _asking_unit_name(res: dict) -> str:
+    """Remove the difference between a reservation of an external unit and a reservation of an internal unit"""
+    # fill the asking_unit_name field with the concatenation of the asking_external_unit and the asking_external_person
+    if res['asking_unit_name'] is None:
+        return res['asking_external_unit'] + ' (' + res['asking_external_person'] + ')'
+    return res['asking_unit_name']
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Reservation:
+    """A reservation from Truffe, parsed once per refresh of the cache"""
+    pk: int
+    state: str
+    title: str
+    asking_unit_name: str
+    contact_phone: str
+    contact_telegram: str
+    start_date: datetime.datetime
+    end_date: datetime.datetime
+    reason: str | None
+    remarks: str | None
+    agreement: str
+    fingerprint: str
 
+    @classmethod
+    def from_json(cls, res: dict) -> 'Reservation':
+        """Build a reservation from its record in the Truffe json"""
+        return cls(
+            pk=res['pk'],
+            state=res['state'],
+            title=res['title'],
+            asking_unit_name=_asking_unit_name(res),
+            contact_phone=res.get('contact_phone'),
+            contact_telegram=res.get('contact_telegram'),
+            start_date=_datetime(res['start_date']),
+            end_date=_datetime(res['end_date']),
+            reason=res.get('reason'),
+            remarks=res.get('remarks'),
+            agreement=get_agreement_url_from_pk(res['pk']),
+            fingerprint=pdfcache.fingerprint(res),
+        )
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Snapshot:
+    """All the reservations of one Truffe refresh, sorted by start date and indexed by pk"""
+    version: int
+    fetched_at: float
+    reservations: tuple[Reservation, ...]
+    by_pk: types.MappingProxyType[int, Reservation]
 
-def _filter_half_day(res_list: [dict], day: int = None, morning: bool = None, future: bool = True) -> [dict]:
-    """Filter a list of reservations to keep only the ones on the half day selected"""
-    date = None
-    if day is None or morning is None:
-        now = datetime.date.today()
-        morning = now.time().hour < 12
-    else:
-        now = datetime.date.today()
-        wd = now.weekday()
-        advance = (day - wd) % 7
+    @classmethod
+    def from_json(cls, data: dict, version: int) -> 'Snapshot':
+        """Parse the whole Truffe json at once"""
+        reservations = sorted(map(Reservation.from_json, data['supplyreservations']), key=lambda res: res.start_date)
+        by_pk = types.MappingProxyType({res.pk: res for res in reservations})
+        return cls(version=version, fetched_at=time.time(), reservations=tuple(reservations), by_pk=by_pk)
+
+
+def get_half_day(day: int = None, morning: bool = None, future: bool = True) -> tuple[datetime.date, bool]:
+    """Returns the date and the half (True for the morning) selected, by default the current half day"""
+    now = datetime.datetime.now(TIMEZONE)
+    date = now.date()
+    if morning is None:
+        morning = now.hour < 12
+    if day is not None:
+        advance = (day - date.weekday()) % 7
         if not future:
             advance -= 7
-        date = now + datetime.timedelta(advance)
-
-    def predicate(res: dict) -> bool:
-        d = _datetime(res['start_date'])
-        is_morning = d.time().hour < 12
-        return d.day == date.day and d.month == date.month and is_morning == morning
+        date += datetime.timedelta(advance)
+    return date, morning
 
-    return list(filter(predicate, res_list))
 
+def get_next_half_day(date: datetime.date, morning: bool) -> tuple[datetime.date, bool]:
+    """Returns the half day following the given one"""
+    if morning:
+        return date, False
+    return date + datetime.timedelta(1), True
 
 
-def _extend_agreement(res_list: list[dict]) -> list[dict]:
-    """Add the agreement field to the reservations"""
-    for res in res_list:
-        res['agreement'] = get_agreement_url_from_pk(res['pk'])
-    return res_list
+def _filter_on_half_day(res_list: list[Reservation], date: datetime.date, morning: bool) -> list[Reservation]:
+    """Keep only the reservations starting on the given half day"""
+    return [res for res in res_list if res.start_date.date() == date and (res.start_date.hour < 12) == morning]
 
 
-def _get_date(date: str) -> str:
+def _get_date(date: datetime.datetime) -> str:
     """Returns a string from a date in the format day/month"""
-    return datetime.datetime.fromisoformat(date).astimezone(
-        pytz.timezone('Europe/Zurich')).strftime("%d/%m")
+    return date.strftime("%d/%m")
 
 
-def _get_time(date: str) -> str:
+def _get_time(date: datetime.datetime) -> str:
     """Returns a string from a date in the format hour:minutes"""
-    return datetime.datetime.fromisoformat(date).astimezone(
-        pytz.timezone('Europe/Zurich')).strftime("%H:%M")
+    return date.strftime("%H:%M")
 
 
-def _get_datetime(date: str) -> str:
+def _get_datetime(date: datetime.datetime) -> str:
     """Returns a string from a date in the format day/month hour:minutes"""
-    return datetime.datetime.fromisoformat(date).astimezone(
-        pytz.timezone('Europe/Zurich')).strftime("%d/%m %H:%M")
-
-
-def _get_json_from_truffe() -> any:
-    """Returns a json of all the reservations"""
-    # Refresh truffe cache every 10 minutes
-    global last_update
-    global truffe_cache
-    if last_update is None or last_update + TRUFFE_CACHE_STALE < time.time():
-        infos = ['asking_unit_name', 'contact_telegram', 'start_date', 'end_date', 'contact_phone', 'reason', 'remarks',
-                 'agreement']
-        url = f"{TRUFFE_PATH}api/supplyreservations?{'&'.join(infos)}"
+    return date.strftime("%d/%m %H:%M")
+
+
+async def _fetch_json_from_truffe() -> any:
+    """Returns a json of all the reservations, straight from Truffe"""
+    infos = ['asking_unit_name', 'contact_telegram', 'start_date', 'end_date', 'contact_phone', 'reason', 'remarks',
+             'agreement']
+    return await truffeclient.get_json(f"api/supplyreservations?{'&'.join(infos)}")
+
+
+async def _fetch_snapshot() -> Snapshot:
+    """Fetch Truffe and replace the current snapshot"""
+    global snapshot
+    global last_refresh_duration
+    global last_refresh_error
+    start = time.perf_counter()
+    try:
+        data = await _fetch_json_from_truffe()
+    except Exception as e:
+        last_refresh_error = repr(e)
+        raise
+    finally:
+        last_refresh_duration = time.perf_counter() - start
+    version = snapshot.version + 1 if snapshot is not None else 0
+    snapshot = Snapshot.from_json(data, version)
+    last_refresh_error = None
+    return snapshot
+
+
+def _start_refresh() -> asyncio.Task:
+    """Start a refresh of the snapshot, unless one is already in flight"""
+    global refresh_task
+    if refresh_task is None or refresh_task.done():
+        refresh_task = asyncio.create_task(_fetch_snapshot())
+        # Retrieve the exception of background refreshes nobody awaits, they are reported in cache_info
+        refresh_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    return refresh_task
+
+
+async def refresh_snapshot() -> Snapshot:
+    """Refresh the snapshot, joining the refresh already in flight if any"""
+    # Shield the shared refresh so that a cancelled reader does not cancel it for the others
+    return await asyncio.shield(_start_refresh())
+
+
+async def get_snapshot() -> Snapshot:
+    """Returns the last good snapshot, refreshing it in the background if it is stale"""
+    if snapshot is None:
+        metrics.inc("cache_misses_total", cache="truffe")
+        return await refresh_snapshot()
+    metrics.inc("cache_hits_total", cache="truffe")
+    if snapshot.fetched_at + TRUFFE_CACHE_STALE < time.time():
+        _start_refresh()
+    return snapshot
+
+
+def cache_info() -> dict[str, any]:
+    """Returns the state of the Truffe cache"""
+    return {
+        'version': snapshot.version if snapshot is not None else None,
+        'age': time.time() - snapshot.fetched_at if snapshot is not None else None,
+        'reservations': len(snapshot.reservations) if snapshot is not None else 0,
+        'refreshing': refresh_task is not None and not refresh_task.done(),
+        'last_refresh_duration': last_refresh_duration,
+        'last_refresh_error': last_refresh_error,
+    }
 
-        headers = {"Accept": "application/json", "Authorization": "Bearer " + TRUFFE_TOKEN}
-        reservations = requests.get(url, headers=headers)
-        truffe_cache = reservations.json()
-        last_update = time.time()
 
-    return copy.deepcopy(truffe_cache)
+async def get_reservations(states: list = DEFAULT_ACCEPTED_STATES) -> list[Reservation]:
+    """Returns a list of all the reservations with one of the given states, sorted by start date"""
+    return [res for res in (await get_snapshot()).reservations if res.state in states]
 
 
-def get_reservations(states: list = DEFAULT_ACCEPTED_STATES,
-                     aggregate_external: bool = True,
-                     standardize_dates: bool = True,
-                     sorted_list: bool = True,
-                     extend_agreement: bool = True) -> list[dict]:
-    """Returns a list of all the reservations with one of the given states"""
-    reservations = _get_json_from_truffe()['supplyreservations']
-    reservations = _remove_external_difference(reservations) if aggregate_external else reservations
-    reservations = _manage_time_shift(reservations) if standardize_dates else reservations
-    reservations = _sort_by_date(reservations) if sorted_list else reservations
-    reservations = _extend_agreement(reservations) if extend_agreement else reservations
-    return list(filter(lambda res: res['state'] in states, reservations))
+async def get_reservation(pk: int) -> Reservation | None:
+    """Returns the reservation with the given pk, in any state, or None if Truffe does not know it"""
+    return (await get_snapshot()).by_pk.get(pk)
 
 
-def get_reservations_half_day(states: list = DEFAULT_ACCEPTED_STATES, day: int = None, morning: bool = None, future = False) -> [dict]:
-    """Returns a list of all the reservations with one of th given states on the half day specified"""
-    return _filter_half_day(get_reservations(states, sorted_list=False), day, morning, future)
+async def get_reservations_half_day(states: list = DEFAULT_ACCEPTED_STATES, date: datetime.date = None,
+                                    morning: bool = None) -> list[Reservation]:
+    """Returns a list of all the reservations with one of the given states on the half day specified, by default the
+    current one. See get_half_day to select a half day from a weekday."""
+    current_date, current_morning = get_half_day()
+    return _filter_on_half_day(await get_reservations(states), current_date if date is None else date,
+                               current_morning if morning is None else morning)
 
 
-def get_res_pk_info(states: list) -> list[tuple[int, str]]:
-    """Returns a list of tuples (pk, title) of all the reservations with one of the given states"""
-    res_list = get_reservations(states)
-    short_infos = [(res['pk'], ' - '.join([_get_datetime(res['start_date']), res['title'], res['asking_unit_name']]))
-                   for res in res_list]
-    return short_infos
+def get_res_short_info(res: Reservation) -> str:
+    """Returns the one line description of a reservation shown in the lists"""
+    return ' - '.join([_get_datetime(res.start_date), res.title, res.asking_unit_name])
 
 
-def get_formatted_reservation_relevant_info_from_pk(pk: int) -> str:
-    """Returns a formatted string with the relevant information of a reservation from its pk"""
-    reservations = get_reservations(State.all_values())
-    reservation = list(filter(lambda res: res['pk'] == pk, reservations))[0]
+async def get_formatted_reservation_relevant_info_from_pk(pk: int) -> str | None:
+    """Returns a formatted string with the relevant information of a reservation from its pk, None if not found"""
+    reservation = await get_reservation(pk)
+    if reservation is None:
+        return None
 
     # Create dict with relevant information
     infos = {
         "status": {
-            "Reservation": reservation['state']
+            "Reservation": reservation.state
         },
         "practical_infos": {
-            "Nom de la réservation": f"Reservation : {reservation['title']}",
-            "Nom de l'unité": f"Unité : {reservation['asking_unit_name']}",
-            "Téléphone": f"Tel : {reservation['contact_phone']}",
-            "Telegram": f"Telegram : {reservation['contact_telegram']}",
-            "Date d'emprunt": f"Prêt le {_get_date(reservation['start_date'])} à {_get_time(reservation['start_date'])}",
-            "Date de rendu": f"Rendu le {_get_date(reservation['end_date'])} à {_get_time(reservation['end_date'])}",
+            "Nom de la réservation": f"Reservation : {reservation.title}",
+            "Nom de l'unité": f"Unité : {reservation.asking_unit_name}",
+            "Téléphone": f"Tel : {reservation.contact_phone}",
+            "Telegram": f"Telegram : {reservation.contact_telegram}",
+            "Date d'emprunt": f"Prêt le {_get_date(reservation.start_date)} à {_get_time(reservation.start_date)}",
+            "Date de rendu": f"Rendu le {_get_date(reservation.end_date)} à {_get_time(reservation.end_date)}",
         },
         "comments": {
-            "Commentaire entité": reservation['reason'],
-            "Commentaire respo log": reservation['remarks']
+            "Commentaire entité": reservation.reason,
+            "Commentaire respo log": reservation.remarks
         }
     }
 
@@ -232,21 +309,38 @@ def get_agreement_url_from_pk(pk: int) -> str:
     return f"{TRUFFE_PATH}loanagreement/{pk}/pdf/"
 
 
-def get_agreement_pdf_from_pk(pk: int):
-    url = f"{TRUFFE_PATH}loanagreement/{pk}/pdf/"
-    response = requests.get(url)
-    return response.content
+async def _get_reservation_fingerprint(pk: int) -> str | None:
+    """Returns the fingerprint of the Truffe record of a reservation, None if it is not in the Truffe json"""
+    reservation = await get_reservation(pk)
+    return reservation.fingerprint if reservation is not None else None
+
+
+async def get_agreement_pdf_from_pk(pk: int) -> bytes:
+    """Returns the agreement of a reservation, from the disk cache if the reservation did not change since"""
+    fingerprint = await _get_reservation_fingerprint(pk)
+    # The disk cache blocks, it runs in a worker thread
+    if fingerprint is not None:
+        agreement = await asyncio.to_thread(pdfcache.get, pk, fingerprint)
+        if agreement is not None:
+            return agreement
+    agreement = await truffeclient.get_bytes(f"loanagreement/{pk}/pdf/")
+    if fingerprint is not None:
+        await asyncio.to_thread(pdfcache.put, pk, fingerprint, agreement)
+    return agreement
+
+
+async def get_agreements_pdf_from_pks(pks: [int], max_concurrent: int = MAX_CONCURRENT_DOWNLOADS) -> list[bytes]:
+    """Download the agreements of the given pks in parallel, returned in the same order as the pks"""
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def download(pk: int) -> bytes:
+        async with semaphore:
+            return await get_agreement_pdf_from_pk(pk)
 
+    return await asyncio.gather(*[download(pk) for pk in pks])
 
-def get_agreements_pdf_merged_from_pks(pks: [int]):
-    agreements = pypdf.PdfWriter()
-    for pk in pks:
-        agreement = io.BytesIO(get_agreement_pdf_from_pk(pk))
-        agreements.append(pypdf.PdfReader(agreement))
-        if len(agreements.pages) % 2 == 1:
-            agreements.add_blank_page()
 
-    agreements_as_bytes = io.BytesIO()
-    agreements.write(agreements_as_bytes)
-    agreements_as_bytes.seek(0)
-    return agreements_as_bytes
\ No newline at end of file
+async def get_agreements_pdf_merged_from_pks(pks: [int], max_concurrent: int = MAX_CONCURRENT_DOWNLOADS):
+    agreements = await get_agreements_pdf_from_pks(pks, max_concurrent)
+    # Parsing and writing pdfs is CPU bound, it runs in another process to keep the bot responsive
+    return io.BytesIO(await pdfmerge.merge_in_pool(agreements))
\ No newline at end of file
@@ -0,0 +1,48 @@
+import httpx
+
+import metrics
+from env import get_config
+
+TRUFFE_PATH = "https://truffe2.agepoly.ch/logistics/"
+
+# Truffe can be slow to build the reservations list, but we never want to hang a handler forever
+TIMEOUT = httpx.Timeout(20.0, connect=5.0)  # seconds
+# Keep a few connections alive so that consecutive calls skip the TCP and TLS handshakes
+LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60)
+
+http_client: httpx.AsyncClient = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it on first use."""
+    global http_client
+    if http_client is None or http_client.is_closed:
+        # requests followed the redirects of Truffe (http to https, trailing slashes), httpx does not by default
+        http_client = httpx.AsyncClient(base_url=TRUFFE_PATH, timeout=TIMEOUT, limits=LIMITS, follow_redirects=True)
+    return http_client
+
+
+async def get_json(path: str) -> any:
+    """Return the json served by Truffe at the given path, relative to TRUFFE_PATH."""
+    headers = {"Accept": "application/json", "Authorization": "Bearer " + get_config().truffe_token}
+    with metrics.dependency("truffe", "json"):
+        response = await _get_client().get(path, headers=headers)
+        response.raise_for_status()
+    return response.json()
+
+
+async def get_bytes(path: str) -> bytes:
+    """Return the raw content served by Truffe at the given path, relative to TRUFFE_PATH."""
+    with metrics.dependency("truffe", "bytes"):
+        response = await _get_client().get(path)
+        response.raise_for_status()
+    return response.content
+
+
+async def close() -> None:
+    """Close the shared HTTP client and its connection pool."""
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+    return
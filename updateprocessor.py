@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+MAX_CONCURRENT_UPDATES = 8  # updates processed at the same time, across all the chats
+MAX_PENDING_UPDATES = 1000  # updates accepted by the processor, running or waiting for their turn
+
+
+def _chat_key(update: object) -> int | None:
+    """The conversation an update belongs to, None if it belongs to none."""
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+    return None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes the updates of different chats concurrently, but the updates of one chat one after the other, in
+    the order Telegram sent them. The base class only bounds the pending updates, so that an update waiting for the
+    previous one of its chat does not hold one of the workers."""
+
+    def __init__(self, workers: int = MAX_CONCURRENT_UPDATES, max_pending: int = MAX_PENDING_UPDATES) -> None:
+        super().__init__(max_pending)
+        self.workers = workers
+        self.worker_slots = asyncio.Semaphore(workers)
+        # chat -> future done when the last update of the chat received so far is processed
+        self.tails: dict[int, asyncio.Future] = {}
+        # chat -> updates of the chat running or waiting
+        self.depths: dict[int, int] = {}
+        self.running = 0
+
+    async def initialize(self) -> None:
+        return
+
+    async def shutdown(self) -> None:
+        return
+
+    async def do_process_update(self, update: object, coroutine: any) -> None:
+        key = _chat_key(update)
+        previous = self.tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self.tails[key] = done
+            self.depths[key] = self.depths.get(key, 0) + 1
+        start = time.perf_counter()
+        started = False
+        try:
+            if previous is not None:
+                # Shielded: cancelling this update must not cancel the future the previous one sets when done
+                await asyncio.shield(previous)
+            async with self.worker_slots:
+                metrics.observe("update_wait_seconds", time.perf_counter() - start)
+                started = True
+                self.running += 1
+                try:
+                    await coroutine
+                finally:
+                    self.running -= 1
+        finally:
+            try:
+                if not started and asyncio.iscoroutine(coroutine):
+                    # Cancelled before its turn, avoid the warning of a coroutine never awaited
+                    coroutine.close()
+            finally:
+                # The next update of the chat waits for this one, whatever happened to it
+                if not done.done():
+                    done.set_result(None)
+                if key is not None:
+                    self.depths[key] -= 1
+                    if self.depths[key] == 0:
+                        del self.depths[key]
+                    if self.tails.get(key) is done:
+                        del self.tails[key]
+        return
+
+    def stats(self) -> dict[str, int]:
+        """Return the updates in progress and the depth of the queues of the chats."""
+        return {
+            'workers': self.workers,
+            'running': self.running,
+            'pending': sum(self.depths.values()),
+            'chats': len(self.depths),
+            'max_chat_depth': max(self.depths.values(), default=0),
+        }
@@ -0,0 +1,89 @@
+import asyncio
+import hmac
+import json
+import signal
+
+import tornado.web
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """Receive the updates Telegram pushes to the webhook and hand them to the application."""
+
+    def initialize(self, bot_application: Application, secret_token: str) -> None:
+        # self.application is the tornado application
+        self.bot_application = bot_application
+        self.secret_token = secret_token
+
+    async def post(self) -> None:
+        if self.request.headers.get("Content-Type") != "application/json":
+            raise tornado.web.HTTPError(403)
+        token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self.secret_token):
+            raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_application.bot)
+        except Exception as e:
+            print("Received an update that could not be parsed.")
+            print(e)
+            raise tornado.web.HTTPError(400)
+        if update is not None:
+            self.bot_application.bot.insert_callback_data(update)
+            await self.bot_application.update_queue.put(update)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serve the metrics in the Prometheus text format, to the holders of the token only."""
+
+    def initialize(self, token: str | None) -> None:
+        self.token = token
+
+    def get(self) -> None:
+        # Without a token configured the metrics are not served at all, the webhook URL is public
+        if self.token is None:
+            raise tornado.web.HTTPError(403)
+        authorization = self.request.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization.encode(), f"Bearer {self.token}".encode()):
+            raise tornado.web.HTTPError(403)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+async def serve(application: Application, port: int, webhook_url: str, secret_token: str,
+                metrics_token: str = None) -> None:
+    """Run the bot behind a webhook, with the metrics served on the same port, until SIGINT or SIGTERM."""
+    web_app = tornado.web.Application([
+        (r"/metrics", MetricsHandler, {"token": metrics_token}),
+        (r"/", WebhookHandler, {"bot_application": application, "secret_token": secret_token}),
+    ])
+    server = web_app.listen(port, address="0.0.0.0")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        # Same sequence as Application.run_webhook, which cannot serve other paths
+        async with application:
+            if application.post_init is not None:
+                await application.post_init(application)
+            await application.bot.set_webhook(url=webhook_url, secret_token=secret_token,
+                                              allowed_updates=Update.ALL_TYPES)
+            await application.start()
+            await stop.wait()
+            await application.stop()
+            if application.post_stop is not None:
+                await application.post_stop(application)
+    finally:
+        server.stop()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+    return
+
+
+def run(application: Application, port: int, webhook_url: str, secret_token: str, metrics_token: str = None) -> None:
+    """Blocking entry point, like Application.run_webhook."""
+    asyncio.run(serve(application, port, webhook_url, secret_token, metrics_token))
+    return